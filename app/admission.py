@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import math
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable
+
+# Routes are grouped into classes, highest priority first. Marketplace treats a slow webhook
+# ack as a failed delivery, so webhooks get their own pool and can't be starved by the others.
+WEBHOOK = "webhook"
+INTERACTIVE = "interactive"
+# Metered usage comes from the publisher's own backend in bursts; it is cheap to accept (memory
+# only) and must not be rate-limited together with, or crowd out, user-facing pages.
+USAGE = "usage"
+ADMIN = "admin"
+PRIORITY_CLASSES = (WEBHOOK, INTERACTIVE, USAGE, ADMIN)
+
+# Never shed: container health probes must keep answering under load.
+_EXEMPT_PATHS = {"/healthz"}
+
+
+def classify(path: str) -> str | None:
+    if path in _EXEMPT_PATHS:
+        return None
+    if path == "/api/webhook":
+        return WEBHOOK
+    if path == "/api/usage":
+        return USAGE
+    if path == "/admin" or path.startswith("/admin/"):
+        return ADMIN
+    # /landing, /api/resolve, /api/activate and any other API route.
+    return INTERACTIVE
+
+
+@dataclass(frozen=True)
+class ClassLimits:
+    max_concurrency: int
+    rate_per_second: float  # <= 0 disables the token bucket
+    max_queue_seconds: float
+
+
+class Shed(Exception):
+    def __init__(self, reason: str, retry_after: float) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ClassLimiter:
+    """Token bucket plus a FIFO concurrency gate for one priority class."""
+
+    def __init__(self, name: str, limits: ClassLimits) -> None:
+        self.name = name
+        self.limits = limits
+        self._burst = max(1.0, limits.rate_per_second)
+        self._tokens = self._burst
+        self._refilled_at = time.monotonic()
+        self._in_flight = 0
+        self._waiters: deque[asyncio.Future[None]] = deque()
+
+        self.admitted = 0
+        self.shed_rate_limited = 0
+        self.shed_queue_timeout = 0
+        self.queue_seconds_total = 0.0
+        self.queue_seconds_max = 0.0
+
+    def _take_token(self) -> None:
+        rate = self.limits.rate_per_second
+        if rate <= 0:
+            return
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * rate)
+        self._refilled_at = now
+        if self._tokens < 1:
+            self.shed_rate_limited += 1
+            raise Shed("rate_limited", (1 - self._tokens) / rate)
+        self._tokens -= 1
+
+    async def acquire(self) -> None:
+        self._take_token()
+        if self._in_flight < self.limits.max_concurrency and not self._waiters:
+            self._in_flight += 1
+            self._record_admit(0.0)
+            return
+
+        started = time.monotonic()
+        waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.limits.max_queue_seconds)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # Handed a slot just as the timeout fired; give it back.
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            self.shed_queue_timeout += 1
+            raise Shed("queue_timeout", self.limits.max_queue_seconds)
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            raise
+        self._record_admit(time.monotonic() - started)
+
+    def release(self) -> None:
+        # Hand the slot straight to the oldest waiter so in_flight never drops below the limit
+        # while requests are queued.
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._in_flight -= 1
+
+    def _record_admit(self, queued: float) -> None:
+        self.admitted += 1
+        self.queue_seconds_total += queued
+        self.queue_seconds_max = max(self.queue_seconds_max, queued)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "maxConcurrency": self.limits.max_concurrency,
+            "ratePerSecond": self.limits.rate_per_second,
+            "maxQueueMs": round(self.limits.max_queue_seconds * 1000, 3),
+            "inFlight": self._in_flight,
+            "queued": len(self._waiters),
+            "admitted": self.admitted,
+            "shedRateLimited": self.shed_rate_limited,
+            "shedQueueTimeout": self.shed_queue_timeout,
+            "queueMsAvg": round(self.queue_seconds_total / self.admitted * 1000, 3) if self.admitted else 0.0,
+            "queueMsMax": round(self.queue_seconds_max * 1000, 3),
+        }
+
+
+class AdmissionController:
+    def __init__(self, limits: dict[str, ClassLimits]) -> None:
+        self.limiters = {name: ClassLimiter(name, limits[name]) for name in PRIORITY_CLASSES}
+
+    def stats(self) -> dict[str, Any]:
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
+
+
+class AdmissionMiddleware:
+    """ASGI middleware that admits, queues or sheds each request by its priority class."""
+
+    def __init__(self, app: Any, *, controller: AdmissionController) -> None:
+        self.app = app
+        self._controller = controller
+
+    async def __call__(self, scope: dict[str, Any], receive: Callable, send: Callable) -> None:
+        priority = classify(scope["path"]) if scope["type"] == "http" else None
+        if priority is None:
+            await self.app(scope, receive, send)
+            return
+
+        limiter = self._controller.limiters[priority]
+        try:
+            await limiter.acquire()
+        except Shed as shed:
+            await _send_503(send, priority, shed)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
+
+
+async def _send_503(send: Callable, priority: str, shed: Shed) -> None:
+    body = json.dumps({"detail": "Server busy", "class": priority, "reason": shed.reason}).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(shed.retry_after))).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any
+
+from .locks import LockHeld, file_lock
+
+
+class BackupInProgress(RuntimeError):
+    pass
+
+
+class BackupManager:
+    """Online SQLite snapshots via the backup API.
+
+    The source connection pins a read snapshot for the whole copy. With the database in WAL
+    mode, writers keep committing meanwhile and the copy never has to restart. The copy runs
+    `pages_per_step` pages at a time and sleeps between steps so it doesn't compete with
+    request handling for I/O and the GIL. Each snapshot is written to a `.partial` file,
+    integrity-checked, then renamed to its final name; only the newest `keep` are retained.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        backup_dir: str | None = None,
+        *,
+        keep: int = 7,
+        pages_per_step: int = 64,
+        pause_seconds: float = 0.005,
+        interval_seconds: float = 0.0,
+        max_restarts: int = 20,
+    ) -> None:
+        self._db_path = db_path
+        self._stem = os.path.splitext(os.path.basename(db_path))[0] or "app"
+        # Only names produced by _run; other files sharing the prefix (e.g. app-cache.db) are left alone.
+        self._snapshot_name = re.compile(rf"{re.escape(self._stem)}-\d{{8}}T\d{{12}}Z\.db")
+        self._dir = backup_dir or os.path.join(os.path.dirname(os.path.abspath(db_path)), "backups")
+        self._keep = max(1, keep)
+        self._pages = max(1, pages_per_step)
+        self._pause = pause_seconds
+        self._interval = interval_seconds
+        self._max_restarts = max_restarts
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.last_result: dict[str, Any] | None = None
+
+    def is_running(self) -> bool:
+        return self._lock.locked()
+
+    def run(self, *, min_age_seconds: float | None = None) -> dict[str, Any] | None:
+        """Take a snapshot now.
+
+        With min_age_seconds, the run is skipped (returns None) if the newest snapshot is
+        younger than that. Every worker process runs the same schedule; the check happens
+        under the cross-process lock, so each interval produces one snapshot in total.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise BackupInProgress("A backup is already running")
+        try:
+            with file_lock(self._db_path + ".backup.lock", blocking=False):
+                if min_age_seconds is not None and self._newest_age() < min_age_seconds:
+                    return None
+                result = self._run()
+            self.last_result = result
+            return result
+        except LockHeld:
+            raise BackupInProgress("A backup is already running in another worker")
+        finally:
+            self._lock.release()
+
+    def _run(self) -> dict[str, Any]:
+        os.makedirs(self._dir, exist_ok=True)
+        # Called with the backup lock held, so any .partial file is left over from a crashed run.
+        for name in os.listdir(self._dir):
+            if name.endswith(".partial") and self._snapshot_name.fullmatch(name[: -len(".partial")]):
+                os.remove(os.path.join(self._dir, name))
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        final_path = os.path.join(self._dir, f"{self._stem}-{stamp}.db")
+        partial_path = final_path + ".partial"
+
+        steps = 0
+        restarts = 0
+        last_remaining: int | None = None
+
+        def progress(_status: int, remaining: int, _total: int) -> None:
+            nonlocal steps, restarts, last_remaining
+            steps += 1
+            # SQLite restarts the copy when another connection writes to the source mid-backup;
+            # that only happens if the snapshot could not be pinned (database not in WAL mode).
+            if last_remaining is not None and remaining > last_remaining:
+                restarts += 1
+                if restarts > self._max_restarts:
+                    # Raising from the callback aborts the copy.
+                    raise RuntimeError(f"Backup restarted {restarts} times under concurrent writes")
+            last_remaining = remaining
+            if remaining and self._pause > 0:
+                time.sleep(self._pause)
+
+        started = time.perf_counter()
+        src = sqlite3.connect(self._db_path, isolation_level=None)
+        dst = sqlite3.connect(partial_path)
+        try:
+            try:
+                src.execute("BEGIN")
+                src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                src.backup(dst, pages=self._pages, progress=progress)
+                src.execute("COMMIT")
+                # Snapshots are standalone files; don't leave them in WAL mode.
+                dst.execute("PRAGMA journal_mode=DELETE")
+                check = dst.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                dst.close()
+                src.close()
+            if check != "ok":
+                raise RuntimeError(f"Backup integrity check failed: {check}")
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+
+        os.replace(partial_path, final_path)
+        removed = self._rotate()
+        return {
+            "path": final_path,
+            "bytes": os.path.getsize(final_path),
+            "steps": steps,
+            "restarts": restarts,
+            "seconds": round(time.perf_counter() - started, 3),
+            "integrity": check,
+            "removed": removed,
+        }
+
+    def _snapshots(self) -> list[str]:
+        if not os.path.isdir(self._dir):
+            return []
+        names = [n for n in os.listdir(self._dir) if self._snapshot_name.fullmatch(n)]
+        # Timestamped names sort chronologically.
+        return sorted(names, reverse=True)
+
+    def _newest_age(self) -> float:
+        """Seconds since the newest snapshot was started, or infinity if there is none."""
+        for name in self._snapshots():
+            stamp = name[len(self._stem) + 1 : -len(".db")]
+            try:
+                taken = datetime.strptime(stamp, "%Y%m%dT%H%M%S%fZ").replace(tzinfo=timezone.utc)
+            except ValueError:
+                continue
+            return (datetime.now(timezone.utc) - taken).total_seconds()
+        return float("inf")
+
+    def _rotate(self) -> list[str]:
+        stale = self._snapshots()[self._keep :]
+        for name in stale:
+            os.remove(os.path.join(self._dir, name))
+        return stale
+
+    def list(self) -> list[dict[str, Any]]:
+        items = []
+        for name in self._snapshots():
+            path = os.path.join(self._dir, name)
+            items.append({"name": name, "bytes": os.path.getsize(path)})
+        return items
+
+    def start(self) -> None:
+        if self._interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="sqlite-backup", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+            self._thread = None
+
+    def _loop(self) -> None:
+        # Wake up more often than the interval so that, whichever worker took the last
+        # snapshot, the next one is taken by whoever gets there first once it is due.
+        while not self._stop.wait(min(self._interval, 60.0)):
+            try:
+                self.run(min_age_seconds=self._interval)
+            except Exception:
+                # Keep the schedule going; the next run starts from scratch.
+                pass
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import os
+
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -14,6 +16,19 @@ class Settings(BaseSettings):
 
     database_path: str = "./data/app.db"
 
+    # Server (python -m app.server). WORKERS > 1 runs one process per worker; they share the
+    # database and a SQLite-backed cache next to it (SHARED_CACHE_PATH, default "<db>-cache.db").
+    host: str = "0.0.0.0"
+    port: int = 8000
+    workers: int = 1
+    shared_cache_path: str | None = None
+
+    def get_shared_cache_path(self) -> str:
+        if self.shared_cache_path:
+            return self.shared_cache_path
+        root, _ = os.path.splitext(self.database_path)
+        return f"{root}-cache.db"
+
     # Admin UI
     # If ADMIN_ENABLED is not set:
     # - enabled in mock mode
@@ -25,6 +40,64 @@ class Settings(BaseSettings):
             return bool(self.admin_enabled)
         return self.marketplace_mode.lower() != "live"
 
+    # Recently seen webhook event ids kept in memory per worker to drop redeliveries early.
+    webhook_dedupe_cache_size: int = 10000
+
+    # Time budget for each incoming request, shared by every upstream step it makes
+    # (Entra token, resolve, activate). 0 disables the deadline (steps fall back to 30s each).
+    request_deadline_ms: float = 10000.0
+
+    # Hedged resolve: if the first attempt is slower than the observed p95, send a second one
+    # and take whichever finishes first. RESOLVE_HEDGE_DELAY_MS is used until enough samples exist.
+    resolve_hedging_enabled: bool = False
+    resolve_hedge_delay_ms: float = 1000.0
+
+    # Metered billing: in-memory aggregates are staged to SQLite every stage interval and
+    # completed hours are reported upstream every flush interval, once the grace period after
+    # the end of the hour has passed.
+    usage_stage_interval_seconds: float = 5.0
+    usage_flush_interval_seconds: float = 60.0
+    usage_flush_grace_seconds: float = 300.0
+    # Shared secret the publisher's backend sends as "Authorization: Bearer <key>" to
+    # POST /api/usage. If unset, the route only accepts reports in mock mode.
+    usage_api_key: str | None = None
+
+    # Online SQLite backups. BACKUP_DIR defaults to "backups" next to DATABASE_PATH;
+    # BACKUP_INTERVAL_SECONDS=0 disables the scheduled job (admin-triggered backups still work).
+    backup_dir: str | None = None
+    backup_keep: int = 7
+    backup_pages_per_step: int = 64
+    backup_pause_ms: float = 5.0
+    backup_interval_seconds: float = 0.0
+
+    # Admission control per priority class (webhook > interactive > usage > admin).
+    # Concurrency limits together should stay within the threadpool size (40 by default) so
+    # a busy class can't occupy every worker thread. A rate of 0 disables the token bucket.
+    admission_enabled: bool = True
+    admission_webhook_concurrency: int = 18
+    admission_webhook_rate: float = 0.0
+    admission_webhook_queue_ms: float = 2000.0
+    admission_interactive_concurrency: int = 14
+    admission_interactive_rate: float = 50.0
+    admission_interactive_queue_ms: float = 1000.0
+    admission_usage_concurrency: int = 4
+    admission_usage_rate: float = 0.0
+    admission_usage_queue_ms: float = 2000.0
+    admission_admin_concurrency: int = 4
+    admission_admin_rate: float = 5.0
+    admission_admin_queue_ms: float = 500.0
+
+    # Per-request profiling (only honoured when the admin UI is enabled).
+    # A request is profiled when it carries PROFILING_HEADER or is picked at PROFILING_SAMPLE_RATE.
+    profiling_enabled: bool = False
+    profiling_header: str = "x-profile"
+    profiling_sample_rate: float = 0.0
+    profiling_interval_ms: float = 5.0
+    profiling_buffer_size: int = 20
+
+    def is_profiling_enabled(self) -> bool:
+        return self.profiling_enabled and self.is_admin_enabled()
+
     # Live-mode auth
     # Env vars: ENTRA_TENANT_ID / ENTRA_CLIENT_ID / ENTRA_CLIENT_SECRET
     entra_tenant_id: str | None = Field(default=None, validation_alias="ENTRA_TENANT_ID")
@@ -4,10 +4,12 @@ import json
 import os
 import sqlite3
 from contextlib import contextmanager
-from dataclasses import dataclass
+from functools import lru_cache
 from datetime import datetime, timezone
 from typing import Any, Iterator
 
+from .locks import file_lock
+
 
 def _utc_now_iso() -> str:
     return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
@@ -20,63 +22,221 @@ def ensure_parent_dir(db_path: str) -> None:
 
 
 @contextmanager
-def connect(db_path: str) -> Iterator[sqlite3.Connection]:
+def connect(db_path: str, *, row_factory: Any = sqlite3.Row) -> Iterator[sqlite3.Connection]:
+    # Pass row_factory=None for plain tuples on hot paths that unpack rows positionally.
     ensure_parent_dir(db_path)
     conn = sqlite3.connect(db_path)
     try:
-        conn.row_factory = sqlite3.Row
+        conn.row_factory = row_factory
         yield conn
     finally:
         conn.close()
 
 
+# Bump when init_db gains schema changes so already-migrated databases pick them up.
+SCHEMA_VERSION = 3
+
+
 def init_db(db_path: str) -> None:
-    with connect(db_path) as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS subscriptions (
-              id TEXT PRIMARY KEY,
-              offer_id TEXT,
-              plan_id TEXT,
-              quantity INTEGER,
-              status TEXT,
-              raw_resolve_json TEXT,
-              created_at TEXT,
-              updated_at TEXT
-            )
-            """
+    # Several worker processes may start at once; the lock makes sure only one of them
+    # migrates and the rest see the bumped user_version and skip.
+    ensure_parent_dir(db_path)
+    with file_lock(db_path + ".migrate.lock"):
+        with connect(db_path) as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+                return
+            _migrate(conn)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.commit()
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    # WAL lets readers (including online backups) hold a snapshot without blocking writers.
+    # The setting is persistent in the database file.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+          id TEXT PRIMARY KEY,
+          offer_id TEXT,
+          plan_id TEXT,
+          quantity INTEGER,
+          status TEXT,
+          raw_resolve_json TEXT,
+          created_at TEXT,
+          updated_at TEXT
         )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS marketplace_tokens (
-              token TEXT PRIMARY KEY,
-              subscription_id TEXT,
-              created_at TEXT
-            )
-            """
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS marketplace_tokens (
+          token TEXT PRIMARY KEY,
+          subscription_id TEXT,
+          created_at TEXT
         )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS webhook_events (
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              subscription_id TEXT,
-              action TEXT,
-              payload_json TEXT,
-              received_at TEXT
-            )
-            """
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS webhook_events (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          subscription_id TEXT,
+          action TEXT,
+          payload_json TEXT,
+          received_at TEXT
+        )
+        """
+    )
+    # Metered usage, pre-aggregated per (subscription, plan, dimension, hour).
+    # status: Pending until submitted, then the Marketplace per-item status (Accepted, Duplicate, Expired, ...).
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS usage_records (
+          subscription_id TEXT NOT NULL,
+          plan_id TEXT NOT NULL,
+          dimension TEXT NOT NULL,
+          hour_start TEXT NOT NULL,
+          quantity REAL NOT NULL,
+          status TEXT NOT NULL,
+          usage_event_id TEXT,
+          error_json TEXT,
+          attempts INTEGER NOT NULL DEFAULT 0,
+          created_at TEXT,
+          updated_at TEXT,
+          PRIMARY KEY (subscription_id, plan_id, dimension, hour_start)
         )
-        conn.commit()
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_usage_records_status ON usage_records (status, hour_start)")
+
+    # v2: idempotent webhook ingestion. event_id identifies a delivery (Marketplace operation id,
+    # or a payload hash) so redeliveries hit the unique index; status_updated_at is the event time
+    # of the status currently stored, used to reject out-of-order updates.
+    _add_column_if_missing(conn, "webhook_events", "event_id", "TEXT")
+    _add_column_if_missing(conn, "webhook_events", "event_time", "TEXT")
+    _add_column_if_missing(conn, "subscriptions", "status_updated_at", "TEXT")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_webhook_events_event_id ON webhook_events (event_id)")
+
+    # v3: usage that arrived after its hour was claimed for submission can't be reported
+    # (Marketplace takes one event per hour); it is kept here so the unbilled amount is visible.
+    _add_column_if_missing(conn, "usage_records", "late_quantity", "REAL NOT NULL DEFAULT 0")
+
+
+def _add_column_if_missing(conn: sqlite3.Connection, table: str, column: str, decl: str) -> None:
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column not in existing:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+# Column sets for get_subscription*; pick the narrowest one the call site needs.
+SUBSCRIPTION_ID_COLUMNS = ("id",)
+SUBSCRIPTION_STATUS_COLUMNS = ("id", "status")
+SUBSCRIPTION_SUMMARY_COLUMNS = ("id", "offer_id", "plan_id", "quantity", "status")
+SUBSCRIPTION_FULL_COLUMNS = (*SUBSCRIPTION_SUMMARY_COLUMNS, "raw_resolve_json")
 
 
-@dataclass(frozen=True)
 class SubscriptionRecord:
+    """Subscription row. Only the projected columns are set; reading any other field raises
+    AttributeError. raw_resolve is decoded from raw_resolve_json on first access."""
+
+    __slots__ = ("id", "offer_id", "plan_id", "quantity", "status", "raw_resolve_json", "_raw_resolve")
+
     id: str
     offer_id: str | None
     plan_id: str | None
     quantity: int | None
     status: str | None
-    raw_resolve: dict[str, Any] | None
+    raw_resolve_json: str | None
+
+    def __init__(
+        self,
+        id: str,
+        offer_id: str | None = None,
+        plan_id: str | None = None,
+        quantity: int | None = None,
+        status: str | None = None,
+        raw_resolve_json: str | None = None,
+    ) -> None:
+        self.id = id
+        self.offer_id = offer_id
+        self.plan_id = plan_id
+        self.quantity = quantity
+        self.status = status
+        self.raw_resolve_json = raw_resolve_json
+
+    @classmethod
+    def from_row(cls, columns: tuple[str, ...], row: tuple[Any, ...]) -> SubscriptionRecord:
+        record = cls.__new__(cls)
+        for name, value in zip(columns, row):
+            setattr(record, name, value)
+        return record
+
+    @property
+    def raw_resolve(self) -> dict[str, Any] | None:
+        try:
+            return self._raw_resolve
+        except AttributeError:
+            raw = self.raw_resolve_json
+            self._raw_resolve: dict[str, Any] | None = json.loads(raw) if raw else None
+            return self._raw_resolve
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in SUBSCRIPTION_SUMMARY_COLUMNS if hasattr(self, name))
+        return f"SubscriptionRecord({fields})"
+
+
+@lru_cache(maxsize=32)
+def _select_list(columns: tuple[str, ...]) -> str:
+    unknown = set(columns) - set(SUBSCRIPTION_FULL_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown subscription columns: {sorted(unknown)}")
+    return ", ".join(f"s.{name}" for name in columns)
+
+
+def _utc_now_precise() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+
+def _apply_status(conn: sqlite3.Connection, subscription_id: str, status: str, event_time: str | None) -> bool:
+    now = _utc_now_iso()
+    if event_time is None:
+        cur = conn.execute(
+            """
+            UPDATE subscriptions
+            SET status = ?, status_updated_at = MAX(COALESCE(status_updated_at, ''), ?), updated_at = ?
+            WHERE id = ?
+            """,
+            (status, _utc_now_precise(), now, subscription_id),
+        )
+    else:
+        cur = conn.execute(
+            """
+            UPDATE subscriptions SET status = ?, status_updated_at = ?, updated_at = ?
+            WHERE id = ? AND (status_updated_at IS NULL OR status_updated_at <= ?)
+            """,
+            (status, event_time, now, subscription_id, event_time),
+        )
+    return cur.rowcount > 0
+
+
+def _insert_webhook_event(
+    conn: sqlite3.Connection,
+    subscription_id: str | None,
+    action: str | None,
+    payload: dict[str, Any],
+    event_id: str | None,
+    event_time: str | None,
+) -> bool:
+    cur = conn.execute(
+        """
+        INSERT INTO webhook_events (subscription_id, action, payload_json, received_at, event_id, event_time)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(event_id) DO NOTHING
+        """,
+        (subscription_id, action, json.dumps(payload, ensure_ascii=False), _utc_now_iso(), event_id, event_time),
+    )
+    return cur.rowcount > 0
 
 
 class Repository:
@@ -84,33 +244,44 @@ class Repository:
         self._db_path = db_path
         init_db(db_path)
 
-    def get_subscription(self, subscription_id: str) -> SubscriptionRecord | None:
-        with connect(self._db_path) as conn:
+    def get_subscription(
+        self,
+        subscription_id: str,
+        *,
+        columns: tuple[str, ...] = SUBSCRIPTION_FULL_COLUMNS,
+    ) -> SubscriptionRecord | None:
+        with connect(self._db_path, row_factory=None) as conn:
             row = conn.execute(
-                "SELECT * FROM subscriptions WHERE id = ?",
+                f"SELECT {_select_list(columns)} FROM subscriptions s WHERE s.id = ?",
                 (subscription_id,),
             ).fetchone()
-            if not row:
-                return None
-            raw = json.loads(row["raw_resolve_json"]) if row["raw_resolve_json"] else None
-            return SubscriptionRecord(
-                id=row["id"],
-                offer_id=row["offer_id"],
-                plan_id=row["plan_id"],
-                quantity=row["quantity"],
-                status=row["status"],
-                raw_resolve=raw,
-            )
+            return SubscriptionRecord.from_row(columns, row) if row else None
 
-    def get_subscription_by_token(self, token: str) -> SubscriptionRecord | None:
-        with connect(self._db_path) as conn:
-            mapping = conn.execute(
-                "SELECT subscription_id FROM marketplace_tokens WHERE token = ?",
+    def get_subscription_by_token(
+        self,
+        token: str,
+        *,
+        columns: tuple[str, ...] = SUBSCRIPTION_FULL_COLUMNS,
+    ) -> SubscriptionRecord | None:
+        with connect(self._db_path, row_factory=None) as conn:
+            row = conn.execute(
+                f"""
+                SELECT {_select_list(columns)} FROM marketplace_tokens t
+                JOIN subscriptions s ON s.id = t.subscription_id
+                WHERE t.token = ?
+                """,
                 (token,),
             ).fetchone()
-            if not mapping:
-                return None
-            return self.get_subscription(mapping["subscription_id"])
+            return SubscriptionRecord.from_row(columns, row) if row else None
+
+    def existing_subscription_ids(self, subscription_ids: set[str]) -> set[str]:
+        if not subscription_ids:
+            return set()
+        ids = sorted(subscription_ids)
+        placeholders = ",".join("?" * len(ids))
+        with connect(self._db_path, row_factory=None) as conn:
+            rows = conn.execute(f"SELECT id FROM subscriptions WHERE id IN ({placeholders})", ids).fetchall()
+            return {row[0] for row in rows}
 
     def upsert_subscription_from_resolve(self, token: str, resolve_json: dict[str, Any]) -> SubscriptionRecord:
         subscription_id = resolve_json.get("id") or resolve_json.get("subscription", {}).get("id")
@@ -154,31 +325,153 @@ class Repository:
             )
             conn.commit()
 
-        return self.get_subscription(subscription_id)  # type: ignore[return-value]
+        record = SubscriptionRecord(subscription_id, offer_id, plan_id, quantity, status, raw_str)
+        record._raw_resolve = resolve_json
+        return record
 
-    def update_status(self, subscription_id: str, status: str) -> None:
+    def update_status(self, subscription_id: str, status: str, *, event_time: str | None = None) -> bool:
+        """Set a subscription's status. Returns False if it was not applied.
+
+        event_time is the (normalized UTC ISO) time Marketplace says the change happened; such
+        updates are skipped if a newer one is already stored, so out-of-order webhooks can't
+        roll the status back. Changes we make ourselves (event_time=None) always apply and only
+        move status_updated_at forward, so a skewed webhook clock can't block them.
+        """
+        with connect(self._db_path) as conn:
+            applied = _apply_status(conn, subscription_id, status, event_time)
+            conn.commit()
+            return applied
+
+    def add_webhook_event(
+        self,
+        subscription_id: str | None,
+        action: str | None,
+        payload: dict[str, Any],
+        *,
+        event_id: str | None = None,
+        event_time: str | None = None,
+    ) -> bool:
+        """Store a webhook delivery. Returns False if an event with the same event_id exists."""
+        with connect(self._db_path) as conn:
+            inserted = _insert_webhook_event(conn, subscription_id, action, payload, event_id, event_time)
+            conn.commit()
+            return inserted
+
+    def apply_webhook_event(
+        self,
+        subscription_id: str | None,
+        action: str | None,
+        payload: dict[str, Any],
+        *,
+        event_id: str,
+        event_time: str | None = None,
+        status: str | None = None,
+    ) -> tuple[bool, bool | None]:
+        """Store a webhook delivery and apply its status in one transaction.
+
+        Returns (inserted, status_applied); status_applied is None when there was nothing to
+        apply. If anything fails, neither write is kept, so a redelivery applies the event again.
+        """
+        with connect(self._db_path) as conn:
+            inserted = _insert_webhook_event(conn, subscription_id, action, payload, event_id, event_time)
+            applied: bool | None = None
+            if inserted and subscription_id and status:
+                # A missing event_time compares as "now", like an update we make ourselves.
+                applied = _apply_status(conn, subscription_id, status, event_time or _utc_now_precise())
+            conn.commit()
+            return inserted, applied
+
+    def stage_usage(self, aggregates: dict[tuple[str, str, str, str], float]) -> int:
+        """Add in-memory usage totals to the durable staging table.
+
+        Keys are (subscription_id, plan_id, dimension, hour_start). Quantities for an hour that
+        is being or has been submitted upstream can't be reported (Marketplace accepts one event
+        per hour); they are added to the row's late_quantity instead, and the number of such
+        aggregates is returned.
+        """
+        if not aggregates:
+            return 0
         now = _utc_now_iso()
+        rows = [(*key, quantity, now, now) for key, quantity in aggregates.items()]
         with connect(self._db_path) as conn:
-            conn.execute(
-                "UPDATE subscriptions SET status = ?, updated_at = ? WHERE id = ?",
-                (status, now, subscription_id),
+            before = conn.total_changes
+            conn.executemany(
+                """
+                UPDATE usage_records SET late_quantity = late_quantity + ?, updated_at = ?
+                WHERE subscription_id = ? AND plan_id = ? AND dimension = ? AND hour_start = ?
+                  AND status != 'Pending'
+                """,
+                [(quantity, now, *key) for key, quantity in aggregates.items()],
+            )
+            late = conn.total_changes - before
+            conn.executemany(
+                """
+                INSERT INTO usage_records (subscription_id, plan_id, dimension, hour_start, quantity, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, 'Pending', ?, ?)
+                ON CONFLICT(subscription_id, plan_id, dimension, hour_start) DO UPDATE SET
+                  quantity=usage_records.quantity + excluded.quantity,
+                  updated_at=excluded.updated_at
+                WHERE usage_records.status = 'Pending'
+                """,
+                rows,
             )
             conn.commit()
+        return late
 
-    def add_webhook_event(self, subscription_id: str | None, action: str | None, payload: dict[str, Any]) -> None:
+    def claim_pending_usage(self, *, closed_before: str, limit: int) -> list[tuple[str, str, str, str, float, int]]:
+        """Move up to `limit` Pending rows of closed hours to InFlight and return them.
+
+        InFlight rows no longer accept staged quantities, so the total recorded as Accepted is
+        exactly the quantity that was sent. Rows left InFlight by a crashed flush are handed out
+        again; resending an hour Marketplace already has comes back as Duplicate.
+        """
+        with connect(self._db_path, row_factory=None) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                """
+                SELECT subscription_id, plan_id, dimension, hour_start, quantity, attempts FROM usage_records
+                WHERE status IN ('Pending', 'InFlight') AND hour_start <= ?
+                ORDER BY hour_start LIMIT ?
+                """,
+                (closed_before, limit),
+            ).fetchall()
+            conn.executemany(
+                """
+                UPDATE usage_records SET status = 'InFlight'
+                WHERE subscription_id = ? AND plan_id = ? AND dimension = ? AND hour_start = ?
+                """,
+                [row[:4] for row in rows],
+            )
+            conn.commit()
+            return rows
+
+    def record_usage_results(self, results: list[tuple[str, str, str, str, str, str | None, str | None]]) -> None:
+        """Apply per-item outcomes: (subscription_id, plan_id, dimension, hour_start, status, usage_event_id, error_json)."""
         now = _utc_now_iso()
         with connect(self._db_path) as conn:
-            conn.execute(
-                "INSERT INTO webhook_events (subscription_id, action, payload_json, received_at) VALUES (?, ?, ?, ?)",
-                (
-                    subscription_id,
-                    action,
-                    json.dumps(payload, ensure_ascii=False),
-                    now,
-                ),
+            conn.executemany(
+                """
+                UPDATE usage_records
+                SET status = ?, usage_event_id = ?, error_json = ?, attempts = attempts + 1, updated_at = ?
+                WHERE subscription_id = ? AND plan_id = ? AND dimension = ? AND hour_start = ? AND status = 'InFlight'
+                """,
+                [(status, event_id, error, now, sub, plan, dim, hour) for sub, plan, dim, hour, status, event_id, error in results],
             )
             conn.commit()
 
+    def count_usage_by_status(self) -> dict[str, int]:
+        with connect(self._db_path) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM usage_records GROUP BY status").fetchall()
+            return {row[0]: row[1] for row in rows}
+
+    def late_usage_totals(self) -> dict[str, float]:
+        """Usage received after its hour was claimed for submission, i.e. never billed."""
+        with connect(self._db_path, row_factory=None) as conn:
+            records, quantity = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(late_quantity), 0) FROM usage_records WHERE late_quantity > 0"
+            ).fetchone()
+            return {"records": records, "quantity": quantity}
+
     def list_subscriptions(self, *, limit: int = 50, offset: int = 0, subscription_id: str | None = None) -> list[dict[str, Any]]:
         limit = max(1, min(int(limit), 500))
         offset = max(0, int(offset))
@@ -191,20 +484,10 @@ class Repository:
         sql += " ORDER BY updated_at DESC LIMIT ? OFFSET ?"
         params.extend([limit, offset])
 
-        with connect(self._db_path) as conn:
+        keys = ("id", "offerId", "planId", "quantity", "status", "createdAt", "updatedAt")
+        with connect(self._db_path, row_factory=None) as conn:
             rows = conn.execute(sql, tuple(params)).fetchall()
-            return [
-                {
-                    "id": row["id"],
-                    "offerId": row["offer_id"],
-                    "planId": row["plan_id"],
-                    "quantity": row["quantity"],
-                    "status": row["status"],
-                    "createdAt": row["created_at"],
-                    "updatedAt": row["updated_at"],
-                }
-                for row in rows
-            ]
+            return [dict(zip(keys, row)) for row in rows]
 
     def list_webhook_events(
         self,
@@ -217,7 +500,10 @@ class Repository:
         limit = max(1, min(int(limit), 500))
         offset = max(0, int(offset))
 
-        sql = "SELECT id, subscription_id, action, payload_json, received_at FROM webhook_events"
+        sql = "SELECT id, subscription_id, action, received_at, event_id"
+        if include_payload:
+            sql += ", payload_json"
+        sql += " FROM webhook_events"
         params: list[Any] = []
         if subscription_id:
             sql += " WHERE subscription_id = ?"
@@ -225,17 +511,14 @@ class Repository:
         sql += " ORDER BY id DESC LIMIT ? OFFSET ?"
         params.extend([limit, offset])
 
-        with connect(self._db_path) as conn:
+        keys = ("id", "subscriptionId", "action", "receivedAt", "eventId")
+        with connect(self._db_path, row_factory=None) as conn:
             rows = conn.execute(sql, tuple(params)).fetchall()
+            if not include_payload:
+                return [dict(zip(keys, row)) for row in rows]
             events: list[dict[str, Any]] = []
             for row in rows:
-                item: dict[str, Any] = {
-                    "id": row["id"],
-                    "subscriptionId": row["subscription_id"],
-                    "action": row["action"],
-                    "receivedAt": row["received_at"],
-                }
-                if include_payload:
-                    item["payload"] = json.loads(row["payload_json"]) if row["payload_json"] else None
+                item = dict(zip(keys, row))
+                item["payload"] = json.loads(row[5]) if row[5] else None
                 events.append(item)
             return events
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import time
+from contextvars import ContextVar
+from typing import Any, Callable
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """A point in time (monotonic clock) by which a request must finish."""
+
+    __slots__ = ("expires_at",)
+
+    def __init__(self, expires_at: float) -> None:
+        self.expires_at = expires_at
+
+    @classmethod
+    def after(cls, seconds: float) -> Deadline:
+        return cls(time.monotonic() + seconds)
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: float) -> float:
+        """Seconds a step may take: the remaining budget, but never more than `cap`."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("Request deadline exceeded")
+        return min(remaining, cap)
+
+
+_current: ContextVar[Deadline | None] = ContextVar("request_deadline", default=None)
+
+
+def current_deadline() -> Deadline | None:
+    return _current.get()
+
+
+def budget(deadline: Deadline | None, cap: float) -> float:
+    """Timeout for one step when a deadline may or may not be set."""
+    return deadline.timeout(cap) if deadline is not None else cap
+
+
+class DeadlineMiddleware:
+    """Starts the request's deadline when it arrives, so queueing time counts against it.
+
+    The deadline is stored in a context variable, which Starlette copies into the threadpool
+    that runs sync endpoints.
+    """
+
+    def __init__(self, app: Any, *, seconds: float) -> None:
+        self.app = app
+        self._seconds = seconds
+
+    async def __call__(self, scope: dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http" or self._seconds <= 0:
+            await self.app(scope, receive, send)
+            return
+        token = _current.set(Deadline.after(self._seconds))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import os
+from contextlib import contextmanager
+from typing import IO, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
+    import msvcrt
+
+
+class LockHeld(RuntimeError):
+    pass
+
+
+def _lock(handle: IO[bytes], blocking: bool) -> None:
+    if fcntl is not None:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    else:
+        msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+
+
+def _unlock(handle: IO[bytes]) -> None:
+    if fcntl is not None:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+    else:
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def file_lock(path: str, *, blocking: bool = True) -> Iterator[None]:
+    """Exclusive lock shared by every worker process on this host.
+
+    With blocking=False, raises LockHeld if another process (or another holder in this
+    process) has the lock.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    with open(path, "a+b") as handle:
+        try:
+            _lock(handle, blocking)
+        except OSError as ex:
+            raise LockHeld(path) from ex
+        try:
+            yield
+        finally:
+            _unlock(handle)
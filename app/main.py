@@ -1,19 +1,108 @@
 from __future__ import annotations
 
-from typing import Any
+import hmac
+import math
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator
 
-from fastapi import Body, FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import Body, FastAPI, Header, HTTPException, Request
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 
+from .admission import ADMIN, INTERACTIVE, USAGE, WEBHOOK, AdmissionController, AdmissionMiddleware, ClassLimits
+from .backup import BackupInProgress, BackupManager
 from .config import get_settings
-from .db import Repository
+from .deadline import DeadlineExceeded, DeadlineMiddleware
+from .db import SUBSCRIPTION_ID_COLUMNS, SUBSCRIPTION_STATUS_COLUMNS, Repository
 from .marketplace import MarketplaceClient
+from .metering import UsageMeter
+from .profiling import ProfiledRoute, ProfileStore, ProfilingMiddleware
+from .shared_cache import SharedCache
+from .webhooks import WebhookDeduplicator, event_key, event_time
 
 settings = get_settings()
 repo = Repository(settings.database_path)
-mp = MarketplaceClient(settings=settings)
+mp = MarketplaceClient(settings=settings, shared_cache=SharedCache(settings.get_shared_cache_path()))
+meter = UsageMeter(
+    repo,
+    mp,
+    stage_interval_seconds=settings.usage_stage_interval_seconds,
+    flush_interval_seconds=settings.usage_flush_interval_seconds,
+    flush_grace_seconds=settings.usage_flush_grace_seconds,
+    lock_path=settings.database_path + ".usage-flush.lock",
+)
+webhook_dedupe = WebhookDeduplicator(settings.webhook_dedupe_cache_size)
+backups = BackupManager(
+    settings.database_path,
+    settings.backup_dir,
+    keep=settings.backup_keep,
+    pages_per_step=settings.backup_pages_per_step,
+    pause_seconds=settings.backup_pause_ms / 1000,
+    interval_seconds=settings.backup_interval_seconds,
+)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    meter.start()
+    backups.start()
+    try:
+        yield
+    finally:
+        backups.stop()
+        meter.stop()
+
+
+app = FastAPI(title="Marketplace SaaS MVP", version="0.1.0", lifespan=lifespan)
+
+profiles = ProfileStore(settings.profiling_buffer_size)
+if settings.is_profiling_enabled():
+    # Installed only when enabled so normal deployments pay nothing for it.
+    app.router.route_class = ProfiledRoute
+    app.add_middleware(
+        ProfilingMiddleware,
+        store=profiles,
+        header=settings.profiling_header,
+        sample_rate=settings.profiling_sample_rate,
+        interval_seconds=settings.profiling_interval_ms / 1000,
+    )
 
-app = FastAPI(title="Marketplace SaaS MVP", version="0.1.0")
+admission = AdmissionController(
+    {
+        WEBHOOK: ClassLimits(
+            settings.admission_webhook_concurrency,
+            settings.admission_webhook_rate,
+            settings.admission_webhook_queue_ms / 1000,
+        ),
+        INTERACTIVE: ClassLimits(
+            settings.admission_interactive_concurrency,
+            settings.admission_interactive_rate,
+            settings.admission_interactive_queue_ms / 1000,
+        ),
+        USAGE: ClassLimits(
+            settings.admission_usage_concurrency,
+            settings.admission_usage_rate,
+            settings.admission_usage_queue_ms / 1000,
+        ),
+        ADMIN: ClassLimits(
+            settings.admission_admin_concurrency,
+            settings.admission_admin_rate,
+            settings.admission_admin_queue_ms / 1000,
+        ),
+    }
+)
+if settings.admission_enabled:
+    # Inside the deadline middleware and outside profiling, so shed requests are rejected
+    # before any other work is done.
+    app.add_middleware(AdmissionMiddleware, controller=admission)
+
+# Outermost, so time spent queued for admission counts against the request's budget.
+app.add_middleware(DeadlineMiddleware, seconds=settings.request_deadline_ms / 1000)
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(_: Request, ex: DeadlineExceeded) -> JSONResponse:
+    return JSONResponse({"detail": str(ex)}, status_code=504)
 
 
 @app.get("/healthz")
@@ -36,7 +125,7 @@ def _require_admin() -> None:
 def landing(token: str | None = None) -> HTMLResponse:
     token = _require_token(token)
 
-    existing = repo.get_subscription_by_token(token)
+    existing = repo.get_subscription_by_token(token, columns=SUBSCRIPTION_STATUS_COLUMNS)
     if existing:
         subscription_id = existing.id
         status = existing.status or "Unknown"
@@ -50,6 +139,8 @@ def landing(token: str | None = None) -> HTMLResponse:
 
     try:
         resolved = mp.resolve(token)
+    except DeadlineExceeded:
+        raise
     except Exception as ex:
         raise HTTPException(status_code=502, detail=f"Resolve failed: {ex}")
 
@@ -87,15 +178,18 @@ def api_activate(payload: dict[str, Any] = Body(...)) -> JSONResponse:
     if not subscription_id:
         raise HTTPException(status_code=400, detail="Missing subscriptionId")
 
-    if not repo.get_subscription(subscription_id):
+    if not repo.get_subscription(subscription_id, columns=SUBSCRIPTION_ID_COLUMNS):
         raise HTTPException(status_code=404, detail="Unknown subscriptionId")
 
     try:
         result = mp.activate(subscription_id)
+    except DeadlineExceeded:
+        raise
     except Exception as ex:
         raise HTTPException(status_code=502, detail=f"Activate failed: {ex}")
 
-    repo.update_status(subscription_id, "Subscribed")
+    if not repo.update_status(subscription_id, "Subscribed"):
+        raise HTTPException(status_code=409, detail="Status not updated")
     return JSONResponse({"subscriptionId": subscription_id, "result": result})
 
 
@@ -103,23 +197,89 @@ def api_activate(payload: dict[str, Any] = Body(...)) -> JSONResponse:
 async def api_webhook(request: Request) -> JSONResponse:
     payload = await request.json()
 
+    # Marketplace redelivers on timeouts; ack duplicates without storing or re-applying them.
+    key = event_key(payload)
+    if webhook_dedupe.seen(key):
+        return JSONResponse({"ok": True, "duplicate": True})
+
     # The webhook schema varies by action; we store the full payload.
     subscription_id = payload.get("subscriptionId") or payload.get("id")
     action = payload.get("action") or payload.get("eventType")
+    occurred_at = event_time(payload)
 
-    repo.add_webhook_event(subscription_id=subscription_id, action=action, payload=payload)
-
-    # If status is present, attempt to apply it.
+    # Event and status change commit together; if this raises, the event isn't marked as seen
+    # and Marketplace's redelivery applies it again.
     status = payload.get("status") or payload.get("saasSubscriptionStatus")
-    if subscription_id and status:
-        try:
-            repo.update_status(subscription_id, status)
-        except Exception:
-            pass
+    inserted, status_applied = repo.apply_webhook_event(
+        subscription_id=subscription_id,
+        action=action,
+        payload=payload,
+        event_id=key,
+        event_time=occurred_at,
+        status=status,
+    )
+    webhook_dedupe.remember(key)
+    if not inserted:
+        webhook_dedupe.record_db_duplicate()
+        return JSONResponse({"ok": True, "duplicate": True})
+    if status_applied is False:
+        # Older than the stored status, or unknown subscription.
+        webhook_dedupe.record_status_not_applied()
 
     return JSONResponse({"ok": True})
 
 
+def _parse_usage_record(item: Any) -> tuple[str, str, str, float, datetime | None]:
+    if not isinstance(item, dict):
+        raise HTTPException(status_code=400, detail="Usage record must be an object")
+    subscription_id = item.get("resourceId") or item.get("subscriptionId")
+    plan_id = item.get("planId")
+    dimension = item.get("dimension")
+    if not (subscription_id and plan_id and dimension):
+        raise HTTPException(status_code=400, detail="Usage record requires resourceId, planId and dimension")
+    try:
+        quantity = float(item.get("quantity", 0))
+        effective = item.get("effectiveStartTime")
+        timestamp = datetime.fromisoformat(str(effective).replace("Z", "+00:00")) if effective else None
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid quantity or effectiveStartTime")
+    if not math.isfinite(quantity) or quantity <= 0:
+        raise HTTPException(status_code=400, detail="quantity must be a positive finite number")
+    return str(subscription_id), str(plan_id), str(dimension), quantity, timestamp
+
+
+def _require_usage_key(authorization: str | None) -> None:
+    # Usage is billed to the customer, so only the publisher's backend may report it.
+    expected = settings.usage_api_key
+    if not expected:
+        if settings.marketplace_mode.lower() == "live":
+            raise HTTPException(status_code=404, detail="Not found")
+        return
+    scheme, _, supplied = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(supplied.encode("utf-8"), expected.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid usage API key", headers={"WWW-Authenticate": "Bearer"})
+
+
+@app.post("/api/usage", status_code=202)
+def api_usage(payload: Any = Body(...), authorization: str | None = Header(default=None)) -> JSONResponse:
+    _require_usage_key(authorization)
+
+    # Accepts a single record, a list of records, or {"items": [...]}.
+    if isinstance(payload, dict) and "items" in payload:
+        payload = payload["items"]
+    items = payload if isinstance(payload, list) else [payload]
+
+    # Validate everything first so a bad record doesn't leave the request half-applied.
+    records = [_parse_usage_record(item) for item in items]
+    resource_ids = {record[0] for record in records}
+    unknown = resource_ids - repo.existing_subscription_ids(resource_ids)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown resourceId: {', '.join(sorted(unknown))}")
+    for subscription_id, plan_id, dimension, quantity, timestamp in records:
+        meter.record(subscription_id, plan_id, dimension, quantity, timestamp)
+    return JSONResponse({"accepted": len(records)}, status_code=202)
+
+
 @app.get("/admin", response_class=HTMLResponse)
 def admin_home() -> HTMLResponse:
         _require_admin()
@@ -323,9 +483,10 @@ def admin_update_subscription_status(subscription_id: str, payload: dict[str, An
         status = payload.get("status")
         if not status:
                 raise HTTPException(status_code=400, detail="Missing status")
-        if not repo.get_subscription(subscription_id):
+        if not repo.get_subscription(subscription_id, columns=SUBSCRIPTION_ID_COLUMNS):
                 raise HTTPException(status_code=404, detail="Unknown subscriptionId")
-        repo.update_status(subscription_id, str(status))
+        if not repo.update_status(subscription_id, str(status)):
+                raise HTTPException(status_code=409, detail="Status not updated")
         return JSONResponse({"ok": True, "subscriptionId": subscription_id, "status": status})
 
 
@@ -344,3 +505,68 @@ def admin_list_webhook_events(
                 include_payload=includePayload,
         )
         return JSONResponse({"items": items, "count": len(items)})
+
+
+@app.get("/admin/api/usage")
+def admin_usage_summary() -> JSONResponse:
+        _require_admin()
+        return JSONResponse(
+                {
+                        "byStatus": repo.count_usage_by_status(),
+                        "inMemory": meter.pending_in_memory(),
+                        "droppedLate": repo.late_usage_totals(),
+                }
+        )
+
+
+@app.get("/admin/api/webhook-stats")
+def admin_webhook_stats() -> JSONResponse:
+        _require_admin()
+        return JSONResponse(webhook_dedupe.stats())
+
+
+@app.get("/admin/api/marketplace")
+def admin_marketplace_stats() -> JSONResponse:
+        _require_admin()
+        return JSONResponse(mp.hedge_stats())
+
+
+@app.get("/admin/api/profiles")
+def admin_list_profiles() -> JSONResponse:
+        _require_admin()
+        items = [p.summary() for p in profiles.list()]
+        return JSONResponse({"enabled": settings.is_profiling_enabled(), "items": items, "count": len(items)})
+
+
+@app.get("/admin/api/profiles/{profile_id}", response_class=PlainTextResponse)
+def admin_get_profile(profile_id: int) -> PlainTextResponse:
+        _require_admin()
+        profile = profiles.get(profile_id)
+        if not profile:
+                raise HTTPException(status_code=404, detail="Unknown profile")
+        return PlainTextResponse(profile.collapsed())
+
+
+@app.get("/admin/api/admission")
+def admin_admission_stats() -> JSONResponse:
+        _require_admin()
+        return JSONResponse({"enabled": settings.admission_enabled, "classes": admission.stats()})
+
+
+@app.get("/admin/api/backups")
+def admin_list_backups() -> JSONResponse:
+        _require_admin()
+        items = backups.list()
+        return JSONResponse({"items": items, "count": len(items), "running": backups.is_running(), "last": backups.last_result})
+
+
+@app.post("/admin/api/backups")
+def admin_run_backup() -> JSONResponse:
+        _require_admin()
+        try:
+                result = backups.run()
+        except BackupInProgress as ex:
+                raise HTTPException(status_code=409, detail=str(ex))
+        except Exception as ex:
+                raise HTTPException(status_code=500, detail=f"Backup failed: {ex}")
+        return JSONResponse(result)
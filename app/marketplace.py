@@ -1,7 +1,11 @@
 from __future__ import annotations
 
+import threading
+import time
 import uuid
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from typing import Any
 
@@ -9,18 +13,73 @@ import httpx
 import msal
 
 from .config import Settings
+from .deadline import Deadline, DeadlineExceeded, budget, current_deadline
+from .shared_cache import SharedCache
+
+
+# Marketplace rejects batchUsageEvent requests with more than 25 items.
+USAGE_BATCH_MAX_ITEMS = 25
+
+# Upper bound for any single upstream step, whatever the remaining request budget.
+_MAX_STEP_SECONDS = 30.0
+
+# Refresh the cached Entra token this long before it expires.
+_TOKEN_REFRESH_MARGIN_SECONDS = 300
+
+
+class LatencyWindow:
+    """Recent latencies of successful calls, for picking a hedge delay."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20) -> None:
+        self._samples: deque[float] = deque(maxlen=size)
+        self._min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        with self._lock:
+            if len(self._samples) < self._min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
 
 
 @dataclass
 class MarketplaceClient:
     settings: Settings
+    # Lets worker processes reuse one Entra token instead of each acquiring its own.
+    shared_cache: SharedCache | None = None
 
     _MOCK_NAMESPACE = uuid.UUID("f7e9a7e8-8c4f-4b6d-9b8c-2f56f6e23d2a")
 
+    _token: tuple[str, float] | None = field(default=None, init=False, repr=False)
+    _token_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+    _resolve_latency: LatencyWindow = field(default_factory=LatencyWindow, init=False, repr=False)
+    _hedge_executor: ThreadPoolExecutor | None = field(default=None, init=False, repr=False)
+    _stats_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+    _resolve_calls: int = field(default=0, init=False, repr=False)
+    _hedges_sent: int = field(default=0, init=False, repr=False)
+    _hedge_wins: int = field(default=0, init=False, repr=False)
+
     def _is_live(self) -> bool:
         return self.settings.marketplace_mode.lower() == "live"
 
-    def _get_access_token(self) -> str:
+    def _get_access_token(self, deadline: Deadline | None = None) -> str:
+        with self._token_lock:
+            if self._token and self._token[1] > time.time():
+                return self._token[0]
+
+        cache_key = f"entra-token:{self.settings.entra_tenant_id}:{self.settings.entra_client_id}"
+        if self.shared_cache is not None:
+            shared = self.shared_cache.get(cache_key)
+            if shared:
+                with self._token_lock:
+                    self._token = (shared["accessToken"], shared["expiresAt"])
+                return shared["accessToken"]
+
         if not (
             self.settings.entra_tenant_id
             and self.settings.entra_client_id
@@ -35,15 +94,122 @@ class MarketplaceClient:
             client_id=self.settings.entra_client_id,
             client_credential=self.settings.entra_client_secret,
             authority=authority,
+            timeout=budget(deadline, _MAX_STEP_SECONDS),
         )
         result = app.acquire_token_for_client(
             scopes=["https://marketplaceapi.microsoft.com/.default"],
         )
         if "access_token" not in result:
             raise RuntimeError(f"Failed to acquire token: {result}")
+        expires_at = time.time() + float(result.get("expires_in", 0)) - _TOKEN_REFRESH_MARGIN_SECONDS
+        with self._token_lock:
+            self._token = (result["access_token"], expires_at)
+        if self.shared_cache is not None:
+            self.shared_cache.set(
+                cache_key,
+                {"accessToken": result["access_token"], "expiresAt": expires_at},
+                expires_at=expires_at,
+            )
         return result["access_token"]
 
-    def resolve(self, marketplace_token: str) -> dict[str, Any]:
+    def _post(
+        self,
+        url: str,
+        headers: dict[str, str],
+        deadline: Deadline | None,
+        body: Any = None,
+    ) -> httpx.Response:
+        params = {"api-version": self.settings.marketplace_api_version}
+        try:
+            with httpx.Client(timeout=budget(deadline, _MAX_STEP_SECONDS)) as client:
+                resp = client.post(url, params=params, headers=headers, json=body)
+        except httpx.TimeoutException as ex:
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded("Request deadline exceeded") from ex
+            raise
+        resp.raise_for_status()
+        return resp
+
+    def resolve(self, marketplace_token: str, *, deadline: Deadline | None = None) -> dict[str, Any]:
+        deadline = deadline or current_deadline()
+        with self._stats_lock:
+            self._resolve_calls += 1
+        if not self.settings.resolve_hedging_enabled:
+            return self._timed_resolve(marketplace_token, deadline)
+        return self._hedged_resolve(marketplace_token, deadline)
+
+    def _timed_resolve(self, marketplace_token: str, deadline: Deadline | None) -> dict[str, Any]:
+        started = time.monotonic()
+        result = self._resolve_once(marketplace_token, deadline)
+        self._resolve_latency.add(time.monotonic() - started)
+        return result
+
+    def _hedged_resolve(self, marketplace_token: str, deadline: Deadline | None) -> dict[str, Any]:
+        # Resolve is idempotent, so a second attempt is safe. Send it once the first attempt has
+        # taken longer than the observed p95 (or the configured delay until enough samples exist).
+        delay = self._resolve_latency.percentile(0.95)
+        if delay is None:
+            delay = self.settings.resolve_hedge_delay_ms / 1000
+
+        executor = self._executor()
+        first = executor.submit(self._timed_resolve, marketplace_token, deadline)
+        done, _ = wait([first], timeout=budget(deadline, delay))
+        if done:
+            return first.result()
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded("Request deadline exceeded")
+
+        pending: set[Future[dict[str, Any]]] = {first}
+        second: Future[dict[str, Any]] | None = None
+        if first.running():
+            second = executor.submit(self._timed_resolve, marketplace_token, deadline)
+            pending.add(second)
+            with self._stats_lock:
+                self._hedges_sent += 1
+        # Otherwise the first attempt is still queued for a thread: the pool is saturated and a
+        # hedge would only queue behind it, so keep waiting for the first attempt instead.
+
+        errors: list[BaseException] = []
+        while pending:
+            done, pending = wait(pending, timeout=budget(deadline, _MAX_STEP_SECONDS), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded("Request deadline exceeded")
+            for fut in done:
+                error = fut.exception()
+                if error is None:
+                    if fut is second:
+                        with self._stats_lock:
+                            self._hedge_wins += 1
+                    # The slower attempt keeps running in the pool; its result is discarded.
+                    return fut.result()
+                errors.append(error)
+        raise errors[0]
+
+    def _executor(self) -> ThreadPoolExecutor:
+        # Room for a first attempt and a hedge for every interactive request admission lets
+        # through, so first attempts don't queue. Losing attempts end by the request deadline
+        # (REQUEST_DEADLINE_MS) rather than holding a thread for the full HTTP timeout.
+        with self._stats_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(
+                    max_workers=2 * max(1, self.settings.admission_interactive_concurrency),
+                    thread_name_prefix="mp-resolve",
+                )
+            return self._hedge_executor
+
+    def hedge_stats(self) -> dict[str, Any]:
+        p95 = self._resolve_latency.percentile(0.95)
+        with self._stats_lock:
+            return {
+                "hedgingEnabled": self.settings.resolve_hedging_enabled,
+                "resolveCalls": self._resolve_calls,
+                "hedgesSent": self._hedges_sent,
+                "hedgeWins": self._hedge_wins,
+                "hedgeWinRate": round(self._hedge_wins / self._hedges_sent, 4) if self._hedges_sent else 0.0,
+                "resolveP95Ms": round(p95 * 1000, 3) if p95 is not None else None,
+            }
+
+    def _resolve_once(self, marketplace_token: str, deadline: Deadline | None) -> dict[str, Any]:
         if not self._is_live():
             subscription_id = str(
                 uuid.uuid5(self._MOCK_NAMESPACE, f"marketplace-token:{marketplace_token}")
@@ -75,8 +241,7 @@ class MarketplaceClient:
             }
 
         url = f"{self.settings.marketplace_api_base}/api/saas/subscriptions/resolve"
-        params = {"api-version": self.settings.marketplace_api_version}
-        token = self._get_access_token()
+        token = self._get_access_token(deadline)
 
         headers = {
             "content-type": "application/json",
@@ -86,12 +251,10 @@ class MarketplaceClient:
             "x-ms-marketplace-token": marketplace_token,
         }
 
-        with httpx.Client(timeout=30) as client:
-            resp = client.post(url, params=params, headers=headers)
-            resp.raise_for_status()
-            return resp.json()
+        return self._post(url, headers, deadline).json()
 
-    def activate(self, subscription_id: str) -> dict[str, Any]:
+    def activate(self, subscription_id: str, *, deadline: Deadline | None = None) -> dict[str, Any]:
+        deadline = deadline or current_deadline()
         if not self._is_live():
             return {
                 "subscriptionId": subscription_id,
@@ -100,8 +263,35 @@ class MarketplaceClient:
             }
 
         url = f"{self.settings.marketplace_api_base}/api/saas/subscriptions/{subscription_id}/activate"
-        params = {"api-version": self.settings.marketplace_api_version}
-        token = self._get_access_token()
+        token = self._get_access_token(deadline)
+
+        headers = {
+            "content-type": "application/json",
+            "authorization": f"Bearer {token}",
+            "x-ms-requestid": str(uuid.uuid4()),
+            "x-ms-correlationid": str(uuid.uuid4()),
+        }
+
+        self._post(url, headers, deadline, body={})
+        return {"subscriptionId": subscription_id, "status": "Subscribed"}
+
+    def post_usage_batch(self, items: list[dict[str, Any]], *, deadline: Deadline | None = None) -> dict[str, Any]:
+        if len(items) > USAGE_BATCH_MAX_ITEMS:
+            raise ValueError(f"Usage batch exceeds {USAGE_BATCH_MAX_ITEMS} items")
+
+        if not self._is_live():
+            now = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+            return {
+                "count": len(items),
+                "result": [
+                    {**item, "usageEventId": str(uuid.uuid4()), "status": "Accepted", "messageTime": now}
+                    for item in items
+                ],
+                "_mock": True,
+            }
+
+        url = f"{self.settings.marketplace_api_base}/api/batchUsageEvent"
+        token = self._get_access_token(deadline)
 
         headers = {
             "content-type": "application/json",
@@ -110,7 +300,4 @@ class MarketplaceClient:
             "x-ms-correlationid": str(uuid.uuid4()),
         }
 
-        with httpx.Client(timeout=30) as client:
-            resp = client.post(url, params=params, headers=headers, json={})
-            resp.raise_for_status()
-            return {"subscriptionId": subscription_id, "status": "Subscribed"}
+        return self._post(url, headers, deadline, body={"request": items}).json()
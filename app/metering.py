@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from .db import Repository
+from .locks import LockHeld, file_lock
+from .marketplace import USAGE_BATCH_MAX_ITEMS, MarketplaceClient
+
+# Per-item statuses that are final from our side; anything else is kept Pending for a retry
+# until max_attempts is reached.
+_DONE_STATUSES = {"Accepted", "Duplicate"}
+_RETRYABLE_STATUSES = {"Error"}
+
+UsageKey = tuple[str, str, str, str]  # (subscription_id, plan_id, dimension, hour_start)
+
+
+def hour_start(ts: datetime) -> str:
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:00:00Z")
+
+
+def _empty_stats() -> dict[str, int]:
+    return {"batches": 0, "submitted": 0, "accepted": 0, "failed": 0, "retrying": 0}
+
+
+def _normalize_time(value: Any) -> str | None:
+    if not value:
+        return None
+    try:
+        return hour_start(datetime.fromisoformat(str(value).replace("Z", "+00:00")))
+    except ValueError:
+        return None
+
+
+class UsageMeter:
+    """Aggregates metered usage in memory, stages it in SQLite and reports it in batches.
+
+    Marketplace accepts a single usage event per (resource, plan, dimension, hour), so only
+    hours that ended at least `flush_grace_seconds` ago are submitted. The grace period gives
+    every worker time to stage the last usage of the hour first.
+    """
+
+    def __init__(
+        self,
+        repo: Repository,
+        client: MarketplaceClient,
+        *,
+        stage_interval_seconds: float = 5.0,
+        flush_interval_seconds: float = 60.0,
+        flush_grace_seconds: float = 300.0,
+        max_attempts: int = 5,
+        max_batches_per_flush: int = 40,
+        lock_path: str | None = None,
+    ) -> None:
+        self._repo = repo
+        self._client = client
+        self._stage_interval = stage_interval_seconds
+        self._flush_interval = flush_interval_seconds
+        self._flush_grace = timedelta(seconds=max(flush_grace_seconds, stage_interval_seconds))
+        self._max_attempts = max_attempts
+        self._max_batches = max_batches_per_flush
+        # With several worker processes, only one of them flushes at a time.
+        self._lock_path = lock_path
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: dict[UsageKey, float] = {}
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def record(
+        self,
+        subscription_id: str,
+        plan_id: str,
+        dimension: str,
+        quantity: float,
+        timestamp: datetime | None = None,
+    ) -> None:
+        key = (subscription_id, plan_id, dimension, hour_start(timestamp or datetime.now(timezone.utc)))
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0.0) + quantity
+
+    def pending_in_memory(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def stage(self) -> int:
+        """Move in-memory aggregates to SQLite. Returns the number of aggregates whose hour was
+        already claimed for reporting; they are kept as late_quantity (see Repository.stage_usage)."""
+        with self._lock:
+            aggregates, self._pending = self._pending, {}
+        try:
+            return self._repo.stage_usage(aggregates)
+        except BaseException:
+            # Nothing was committed; put the totals back so the next stage retries them.
+            with self._lock:
+                for key, quantity in aggregates.items():
+                    self._pending[key] = self._pending.get(key, 0.0) + quantity
+            raise
+
+    def flush(self, *, now: datetime | None = None) -> dict[str, int]:
+        with self._flush_lock:
+            if self._lock_path is None:
+                return self._flush(now)
+            try:
+                with file_lock(self._lock_path, blocking=False):
+                    return self._flush(now)
+            except LockHeld:
+                # Another worker is flushing; its run covers the same pending rows.
+                return _empty_stats()
+
+    def _flush(self, now: datetime | None) -> dict[str, int]:
+        stats = _empty_stats()
+        now = now or datetime.now(timezone.utc)
+        closed_before = hour_start(now - timedelta(hours=1) - self._flush_grace)
+
+        rows = self._repo.claim_pending_usage(
+            closed_before=closed_before,
+            limit=USAGE_BATCH_MAX_ITEMS * self._max_batches,
+        )
+        for i in range(0, len(rows), USAGE_BATCH_MAX_ITEMS):
+            batch = rows[i : i + USAGE_BATCH_MAX_ITEMS]
+            items = [
+                {
+                    "resourceId": sub,
+                    "planId": plan,
+                    "dimension": dim,
+                    "effectiveStartTime": hour,
+                    "quantity": quantity,
+                }
+                for sub, plan, dim, hour, quantity, _ in batch
+            ]
+            attempts = {row[:4]: row[5] for row in batch}
+            stats["batches"] += 1
+            stats["submitted"] += len(items)
+            try:
+                response = self._client.post_usage_batch(items)
+            except Exception as ex:
+                outcomes = {row[:4]: ("Error", None, json.dumps({"message": str(ex)})) for row in batch}
+                self._apply(outcomes, attempts, stats)
+                # Leave the remaining batches for the next flush rather than hammering a failing endpoint.
+                break
+            self._apply(self._reconcile(batch, response), attempts, stats)
+        return stats
+
+    def _reconcile(
+        self,
+        batch: list[tuple[str, str, str, str, float, int]],
+        response: dict[str, Any],
+    ) -> dict[UsageKey, tuple[str, str | None, str | None]]:
+        outcomes: dict[UsageKey, tuple[str, str | None, str | None]] = {}
+        for result in response.get("result") or []:
+            key = (
+                str(result.get("resourceId")),
+                str(result.get("planId")),
+                str(result.get("dimension")),
+                _normalize_time(result.get("effectiveStartTime")) or "",
+            )
+            error = result.get("error")
+            outcomes[key] = (
+                str(result.get("status") or "Error"),
+                result.get("usageEventId"),
+                json.dumps(error, ensure_ascii=False) if error else None,
+            )
+
+        missing = json.dumps({"message": "Item missing from batch result"})
+        for row in batch:
+            outcomes.setdefault(row[:4], ("Error", None, missing))
+        # Ignore results that don't correspond to an item we sent.
+        sent = {row[:4] for row in batch}
+        return {key: outcome for key, outcome in outcomes.items() if key in sent}
+
+    def _apply(
+        self,
+        outcomes: dict[UsageKey, tuple[str, str | None, str | None]],
+        attempts: dict[UsageKey, int],
+        stats: dict[str, int],
+    ) -> None:
+        results = []
+        for key, (status, event_id, error) in outcomes.items():
+            if status in _DONE_STATUSES:
+                stats["accepted"] += 1
+            elif status in _RETRYABLE_STATUSES and attempts.get(key, 0) + 1 < self._max_attempts:
+                stats["retrying"] += 1
+                status = "Pending"
+            else:
+                stats["failed"] += 1
+            results.append((*key, status, event_id, error))
+        self._repo.record_usage_results(results)
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="usage-meter", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.stage()
+
+    def _run(self) -> None:
+        last_flush = time.monotonic()
+        while not self._stop.wait(self._stage_interval):
+            try:
+                self.stage()
+                if time.monotonic() - last_flush >= self._flush_interval:
+                    last_flush = time.monotonic()
+                    self.flush()
+            except Exception:
+                # Keep the flusher alive; rows stay Pending and are retried on the next tick.
+                pass
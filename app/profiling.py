@@ -0,0 +1,243 @@
+from __future__ import annotations
+
+import functools
+import inspect
+import itertools
+import random
+import sys
+import threading
+import time
+import types
+from collections import Counter, deque
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from types import FrameType
+from typing import Any, Callable, Coroutine, Generator
+
+from fastapi.routing import APIRoute
+
+_MAX_STACK_DEPTH = 128
+
+_current: ContextVar["RequestProfile | None"] = ContextVar("request_profile", default=None)
+
+
+@dataclass
+class RequestProfile:
+    id: int
+    method: str
+    path: str
+    started_at: str
+    status_code: int | None = None
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    samples: Counter[str] = field(default_factory=Counter)
+    _threads: set[int] = field(default_factory=set)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add_thread(self, thread_id: int) -> None:
+        with self._lock:
+            self._threads.add(thread_id)
+
+    def remove_thread(self, thread_id: int, cpu_seconds: float) -> None:
+        with self._lock:
+            self._threads.discard(thread_id)
+            self.cpu_seconds += cpu_seconds
+
+    def sample(self) -> None:
+        with self._lock:
+            threads = tuple(self._threads)
+        frames = sys._current_frames()
+        for thread_id in threads:
+            frame = frames.get(thread_id)
+            if frame is not None:
+                self.samples[_collapse(frame)] += 1
+
+    def collapsed(self) -> str:
+        """Brendan Gregg's folded format: one "root;...;leaf count" line per stack."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "statusCode": self.status_code,
+            "startedAt": self.started_at,
+            "wallMs": round(self.wall_seconds * 1000, 3),
+            "cpuMs": round(self.cpu_seconds * 1000, 3),
+            "samples": sum(self.samples.values()),
+        }
+
+
+def _collapse(frame: FrameType | None) -> str:
+    names: list[str] = []
+    while frame is not None and len(names) < _MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}")
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class ProfileStore:
+    """Keeps the last `capacity` request profiles."""
+
+    def __init__(self, capacity: int) -> None:
+        self._profiles: deque[RequestProfile] = deque(maxlen=max(1, capacity))
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def new_profile(self, method: str, path: str) -> RequestProfile:
+        started_at = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+        return RequestProfile(id=next(self._ids), method=method, path=path, started_at=started_at)
+
+    def add(self, profile: RequestProfile) -> None:
+        with self._lock:
+            self._profiles.append(profile)
+
+    def list(self) -> list[RequestProfile]:
+        with self._lock:
+            return list(reversed(self._profiles))
+
+    def get(self, profile_id: int) -> RequestProfile | None:
+        with self._lock:
+            return next((p for p in self._profiles if p.id == profile_id), None)
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, profile: RequestProfile, interval_seconds: float) -> None:
+        super().__init__(name=f"profile-sampler-{profile.id}", daemon=True)
+        self._profile = profile
+        self._interval = interval_seconds
+        self._done = threading.Event()
+
+    def run(self) -> None:
+        while not self._done.wait(self._interval):
+            self._profile.sample()
+
+    def stop(self) -> None:
+        # Called on the event loop, so don't join: the thread is a daemon, only touches its
+        # profile and exits within one interval. A sample taken after this is harmless.
+        self._done.set()
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that samples the stacks of selected requests.
+
+    A request is profiled when it carries the trigger header or is picked by the sampling rate.
+    The middleware only measures wall time; ProfiledRoute registers the threads that run the
+    endpoint, so CPU time and samples never include other requests sharing the event loop.
+    """
+
+    def __init__(
+        self,
+        app: Any,
+        *,
+        store: ProfileStore,
+        header: str = "x-profile",
+        sample_rate: float = 0.0,
+        interval_seconds: float = 0.005,
+    ) -> None:
+        self.app = app
+        self._store = store
+        self._header = header.lower().encode("latin-1")
+        self._sample_rate = sample_rate
+        self._interval = interval_seconds
+
+    def _should_profile(self, scope: dict[str, Any]) -> bool:
+        if scope["path"].startswith("/admin/api/profiles"):
+            return False
+        if any(name == self._header for name, _ in scope["headers"]):
+            return True
+        return self._sample_rate > 0 and random.random() < self._sample_rate
+
+    async def __call__(self, scope: dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = self._store.new_profile(scope["method"], scope["path"])
+
+        async def send_wrapper(message: dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                profile.status_code = message["status"]
+            await send(message)
+
+        token = _current.set(profile)
+        sampler = _Sampler(profile, self._interval)
+        sampler.start()
+        wall_start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile.wall_seconds = time.perf_counter() - wall_start
+            sampler.stop()
+            _current.reset(token)
+            self._store.add(profile)
+
+
+@types.coroutine
+def _drive(coro: Coroutine[Any, Any, Any], profile: RequestProfile) -> Generator[Any, Any, Any]:
+    """Run `coro` step by step, registering the event loop thread only while a step executes.
+
+    Between steps the loop serves other requests or waits in select(); neither is charged
+    to this profile.
+    """
+    thread_id = threading.get_ident()
+    value: Any = None
+    error: BaseException | None = None
+    while True:
+        profile.add_thread(thread_id)
+        cpu_start = time.thread_time()
+        try:
+            yielded = coro.send(value) if error is None else coro.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            profile.remove_thread(thread_id, time.thread_time() - cpu_start)
+        value, error = None, None
+        try:
+            value = yield yielded
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as ex:
+            error = ex
+
+
+def _track_thread(func: Callable[..., Any]) -> Callable[..., Any]:
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+            profile = _current.get()
+            if profile is None:
+                return await func(*args, **kwargs)
+            return await _drive(func(*args, **kwargs), profile)
+
+        async_wrapper.__signature__ = inspect.signature(func, eval_str=True)  # type: ignore[attr-defined]
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        profile = _current.get()
+        if profile is None:
+            return func(*args, **kwargs)
+        thread_id = threading.get_ident()
+        profile.add_thread(thread_id)
+        cpu_start = time.thread_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.remove_thread(thread_id, time.thread_time() - cpu_start)
+
+    # FastAPI resolves string annotations against the callable's module globals,
+    # so hand it the already-evaluated signature of the real endpoint.
+    wrapper.__signature__ = inspect.signature(func, eval_str=True)  # type: ignore[attr-defined]
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs: Any) -> None:
+        super().__init__(path, _track_thread(endpoint), **kwargs)
@@ -0,0 +1,28 @@
+"""Server entrypoint: ``python -m app.server``.
+
+Runs migrations once in the supervisor process, then starts ``Settings.workers`` uvicorn
+worker processes. Workers are started fresh (uvicorn uses the spawn start method), so every
+database connection, background thread and lock is created inside the worker itself.
+"""
+
+from __future__ import annotations
+
+import uvicorn
+
+from .config import get_settings
+from .db import init_db
+
+
+def main() -> None:
+    settings = get_settings()
+    init_db(settings.database_path)
+    uvicorn.run(
+        "app.main:app",
+        host=settings.host,
+        port=settings.port,
+        workers=max(1, settings.workers),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import time
+from typing import Any
+
+from .db import connect
+
+
+class SharedCache:
+    """Small key/value cache with expiry, shared by all worker processes through a SQLite file.
+
+    It lives in its own file, next to the database, so short-lived secrets such as access
+    tokens never end up in backups of the main database.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        with connect(path) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache (
+                  key TEXT PRIMARY KEY,
+                  value_json TEXT NOT NULL,
+                  expires_at REAL NOT NULL
+                )
+                """
+            )
+            conn.commit()
+
+    def get(self, key: str) -> Any | None:
+        try:
+            with connect(self._path, row_factory=None) as conn:
+                row = conn.execute(
+                    "SELECT value_json FROM cache WHERE key = ? AND expires_at > ?",
+                    (key, time.time()),
+                ).fetchone()
+        except sqlite3.Error:
+            # The cache is an optimization; callers fall back to fetching the value.
+            return None
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any, *, expires_at: float) -> None:
+        try:
+            with connect(self._path) as conn:
+                conn.execute(
+                    """
+                    INSERT INTO cache (key, value_json, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET value_json=excluded.value_json, expires_at=excluded.expires_at
+                    """,
+                    (key, json.dumps(value), expires_at),
+                )
+                conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+                conn.commit()
+        except sqlite3.Error:
+            pass
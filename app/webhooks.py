@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any
+
+
+def event_key(payload: dict[str, Any]) -> str:
+    """Identity of a webhook delivery, stable across Marketplace redeliveries.
+
+    Marketplace sends the operation id as "id" next to "subscriptionId". Without one, the hash
+    of the canonical payload is used, since redelivered copies carry the same body.
+    """
+    for name in ("operationId", "eventId"):
+        if payload.get(name):
+            return str(payload[name])
+    if payload.get("id") and payload.get("subscriptionId"):
+        return str(payload["id"])
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return "sha256:" + hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def event_time(payload: dict[str, Any]) -> str | None:
+    """The event's own timestamp as a sortable UTC ISO string, or None if absent/unparseable."""
+    value = payload.get("timeStamp") or payload.get("timestamp")
+    if not value:
+        return None
+    try:
+        ts = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+
+class WebhookDeduplicator:
+    """Bounded LRU of recently stored event keys plus ingestion counters.
+
+    The LRU is per process and only saves a SQLite round trip; the unique index on
+    webhook_events.event_id is what guarantees each event is stored once.
+    """
+
+    def __init__(self, capacity: int = 10000) -> None:
+        self._capacity = max(1, capacity)
+        self._seen: OrderedDict[str, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.received = 0
+        self.duplicates_memory = 0
+        self.duplicates_db = 0
+        # Status updates not applied: older than the stored status, or unknown subscription.
+        self.status_not_applied = 0
+
+    def seen(self, key: str) -> bool:
+        with self._lock:
+            self.received += 1
+            if key in self._seen:
+                self._seen.move_to_end(key)
+                self.duplicates_memory += 1
+                return True
+            return False
+
+    def remember(self, key: str) -> None:
+        with self._lock:
+            self._seen[key] = None
+            self._seen.move_to_end(key)
+            if len(self._seen) > self._capacity:
+                self._seen.popitem(last=False)
+
+    def record_db_duplicate(self) -> None:
+        with self._lock:
+            self.duplicates_db += 1
+
+    def record_status_not_applied(self) -> None:
+        with self._lock:
+            self.status_not_applied += 1
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            duplicates = self.duplicates_memory + self.duplicates_db
+            return {
+                "received": self.received,
+                "duplicates": duplicates,
+                "duplicatesFromMemory": self.duplicates_memory,
+                "duplicatesFromDb": self.duplicates_db,
+                "duplicateRate": round(duplicates / self.received, 4) if self.received else 0.0,
+                "statusNotApplied": self.status_not_applied,
+                "cacheSize": len(self._seen),
+                "cacheCapacity": self._capacity,
+            }
@@ -0,0 +1,80 @@
+"""Micro-benchmark: SubscriptionRecord reads and admin list rows.
+
+Compares the previous access pattern (sqlite3.Row + eager json.loads + per-row dict
+built by column name) with the current one (column projection, lazy raw_resolve,
+tuple rows). Run from the repo root:
+
+    python benchmarks/bench_subscription_records.py
+"""
+
+from __future__ import annotations
+
+import json
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.db import SUBSCRIPTION_ID_COLUMNS, SUBSCRIPTION_STATUS_COLUMNS, Repository, connect  # noqa: E402
+from app.marketplace import MarketplaceClient  # noqa: E402
+from app.config import Settings  # noqa: E402
+
+ROWS = 500
+
+
+def _legacy_get_subscription(db_path: str, subscription_id: str) -> dict[str, Any] | None:
+    with connect(db_path) as conn:
+        row = conn.execute("SELECT * FROM subscriptions WHERE id = ?", (subscription_id,)).fetchone()
+        if not row:
+            return None
+        raw = json.loads(row["raw_resolve_json"]) if row["raw_resolve_json"] else None
+        return {"id": row["id"], "offer_id": row["offer_id"], "plan_id": row["plan_id"],
+                "quantity": row["quantity"], "status": row["status"], "raw_resolve": raw}
+
+
+def _legacy_list_subscriptions(db_path: str) -> list[dict[str, Any]]:
+    with connect(db_path) as conn:
+        rows = conn.execute(
+            "SELECT id, offer_id, plan_id, quantity, status, created_at, updated_at FROM subscriptions"
+            " ORDER BY updated_at DESC LIMIT 500"
+        ).fetchall()
+        return [
+            {"id": r["id"], "offerId": r["offer_id"], "planId": r["plan_id"], "quantity": r["quantity"],
+             "status": r["status"], "createdAt": r["created_at"], "updatedAt": r["updated_at"]}
+            for r in rows
+        ]
+
+
+def _measure(name: str, fn: Callable[[], Any], number: int) -> None:
+    fn()
+    seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<34} {seconds * 1e6:10.1f} us/op  {peak / 1024:8.1f} KiB peak")
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = str(Path(tmp) / "bench.db")
+        repo = Repository(db_path)
+        client = MarketplaceClient(settings=Settings(marketplace_mode="mock"))
+        ids = [repo.upsert_subscription_from_resolve(f"tok-{i}", client.resolve(f"tok-{i}")).id for i in range(ROWS)]
+        sub_id = ids[ROWS // 2]
+
+        _measure("get_subscription (legacy)", lambda: _legacy_get_subscription(db_path, sub_id), 2000)
+        _measure("get_subscription (full, lazy)", lambda: repo.get_subscription(sub_id), 2000)
+        _measure("get_subscription (id, status)",
+                 lambda: repo.get_subscription(sub_id, columns=SUBSCRIPTION_STATUS_COLUMNS), 2000)
+        _measure("get_subscription (id)", lambda: repo.get_subscription(sub_id, columns=SUBSCRIPTION_ID_COLUMNS), 2000)
+        _measure("list_subscriptions (legacy)", lambda: _legacy_list_subscriptions(db_path), 200)
+        _measure("list_subscriptions (tuples)", lambda: repo.list_subscriptions(limit=500), 200)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
 from __future__ import annotations
 
+import asyncio
+import multiprocessing
 import os
 import importlib
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
+import pytest
 from fastapi.testclient import TestClient
 
 
@@ -108,3 +115,662 @@ def test_admin_disabled_returns_404(tmp_path: Path) -> None:
     client = _new_client_with_admin(tmp_path, enabled=False)
     r = client.get("/admin")
     assert r.status_code == 404
+
+
+def _add_subscriptions(*subscription_ids: str) -> None:
+    import app.main as main  # noqa: WPS433
+
+    for subscription_id in subscription_ids:
+        main.repo.upsert_subscription_from_resolve(f"token-{subscription_id}", {"id": subscription_id})
+
+
+def test_usage_is_aggregated_and_flushed_in_batches(tmp_path: Path) -> None:
+    client = _new_client(tmp_path)
+    import app.main as main  # noqa: WPS433
+
+    _add_subscriptions(*(f"sub-{i}" for i in range(30)))
+
+    hour = datetime(2026, 1, 1, 8, tzinfo=timezone.utc)
+    records = [
+        {
+            "resourceId": f"sub-{i % 30}",
+            "planId": "demo-plan",
+            "dimension": "requests",
+            "quantity": 1,
+            "effectiveStartTime": (hour + timedelta(minutes=i % 60)).isoformat(),
+        }
+        for i in range(300)
+    ]
+    r = client.post("/api/usage", json={"items": records})
+    assert r.status_code == 202
+    assert r.json()["accepted"] == 300
+    assert main.meter.pending_in_memory() == 30
+
+    calls: list[int] = []
+    post = main.mp.post_usage_batch
+
+    def _counting_post(items: list[dict]) -> dict:
+        calls.append(len(items))
+        return post(items)
+
+    main.mp.post_usage_batch = _counting_post  # type: ignore[method-assign]
+    main.meter.stage()
+    stats = main.meter.flush(now=hour + timedelta(hours=2))
+
+    assert calls == [25, 5]
+    assert stats["accepted"] == 30
+    assert main.repo.count_usage_by_status() == {"Accepted": 30}
+
+
+def test_usage_api_requires_key_and_known_subscriptions(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setenv("USAGE_API_KEY", "publisher-secret")
+    client = _new_client(tmp_path)
+    import app.main as main  # noqa: WPS433
+
+    _add_subscriptions("sub-1")
+    record = {"resourceId": "sub-1", "planId": "p", "dimension": "d", "quantity": 1}
+    auth = {"Authorization": "Bearer publisher-secret"}
+
+    assert client.post("/api/usage", json=record).status_code == 401
+    assert client.post("/api/usage", json=record, headers={"Authorization": "Bearer guess"}).status_code == 401
+    assert client.post("/api/usage", json=record, headers=auth).status_code == 202
+
+    r = client.post("/api/usage", json=[record, {**record, "resourceId": "someone-else"}], headers=auth)
+    assert r.status_code == 400
+    assert "someone-else" in r.json()["detail"]
+    assert main.meter.pending_in_memory() == 1
+
+    monkeypatch.delenv("USAGE_API_KEY")
+    monkeypatch.setenv("MARKETPLACE_MODE", "live")
+    importlib.reload(main)
+    # Without a key, live deployments don't expose the route at all.
+    assert TestClient(main.app).post("/api/usage", json=record).status_code == 404
+
+
+def test_usage_flush_reconciles_per_item_results(tmp_path: Path) -> None:
+    _new_client(tmp_path)
+    import app.main as main  # noqa: WPS433
+
+    hour = datetime(2026, 1, 1, 8, tzinfo=timezone.utc)
+    main.meter.record("sub-ok", "demo-plan", "requests", 5, hour)
+    main.meter.record("sub-gone", "demo-plan", "requests", 5, hour)
+    main.meter.record("sub-retry", "demo-plan", "requests", 5, hour)
+    # The current hour is still open and must not be submitted.
+    main.meter.record("sub-ok", "demo-plan", "requests", 5, hour + timedelta(hours=2))
+    main.meter.stage()
+
+    def _post(items: list[dict]) -> dict:
+        status = {"sub-ok": "Accepted", "sub-gone": "ResourceNotFound", "sub-retry": "Error"}
+        return {"result": [{**item, "status": status[item["resourceId"]]} for item in items]}
+
+    main.mp.post_usage_batch = _post  # type: ignore[method-assign]
+    stats = main.meter.flush(now=hour + timedelta(hours=2, minutes=30))
+
+    assert stats["submitted"] == 3
+    assert main.repo.count_usage_by_status() == {"Accepted": 1, "ResourceNotFound": 1, "Pending": 2}
+
+
+def test_profiling_captures_header_triggered_requests(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setenv("PROFILING_ENABLED", "true")
+    monkeypatch.setenv("PROFILING_INTERVAL_MS", "1")
+    client = _new_client(tmp_path)
+
+    assert client.get("/landing?token=not-profiled").status_code == 200
+    assert client.get("/landing?token=profiled", headers={"x-profile": "1"}).status_code == 200
+
+    r = client.get("/admin/api/profiles")
+    assert r.status_code == 200
+    items = r.json()["items"]
+    assert [i["path"] for i in items] == ["/landing"]
+    assert items[0]["statusCode"] == 200
+
+    r2 = client.get(f"/admin/api/profiles/{items[0]['id']}")
+    assert r2.status_code == 200
+    for line in r2.text.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert stack and int(count) > 0
+
+
+def test_profiling_async_endpoint_excludes_idle_event_loop(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setenv("PROFILING_ENABLED", "true")
+    monkeypatch.setenv("PROFILING_INTERVAL_MS", "1")
+    client = _new_client(tmp_path)
+    import app.main as main  # noqa: WPS433
+
+    async def waits() -> dict[str, bool]:
+        await asyncio.sleep(0.1)
+        return {"ok": True}
+
+    main.app.add_api_route("/api/test-waits", waits)
+    assert client.get("/api/test-waits", headers={"x-profile": "1"}).json() == {"ok": True}
+
+    item = client.get("/admin/api/profiles").json()["items"][0]
+    assert item["path"] == "/api/test-waits"
+    assert item["wallMs"] >= 100
+    # The loop thread is only tracked while it runs the endpoint, not while it waits in select().
+    assert item["cpuMs"] < 50
+    assert "selectors:" not in client.get(f"/admin/api/profiles/{item['id']}").text
+
+
+def test_profiling_sampler_stop_does_not_block() -> None:
+    from app.profiling import ProfileStore, _Sampler
+
+    profile = ProfileStore(1).new_profile("GET", "/slow-sample")
+    profile.sample = lambda: time.sleep(0.5)  # type: ignore[method-assign]
+    sampler = _Sampler(profile, 0.001)
+    sampler.start()
+    time.sleep(0.05)
+
+    # stop() runs on the event loop; it must not wait for an in-progress sample.
+    started = time.monotonic()
+    sampler.stop()
+    assert time.monotonic() - started < 0.1
+    sampler.join()
+
+
+def test_profiling_requires_admin(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setenv("PROFILING_ENABLED", "true")
+    client = _new_client_with_admin(tmp_path, enabled=False)
+
+    import app.main as main  # noqa: WPS433
+
+    assert client.get("/healthz", headers={"x-profile": "1"}).status_code == 200
+    assert main.profiles.list() == []
+    assert client.get("/admin/api/profiles").status_code == 404
+
+
+def test_subscription_record_projection_and_lazy_raw_resolve(tmp_path: Path) -> None:
+    from app.db import SUBSCRIPTION_STATUS_COLUMNS, Repository
+
+    repo = Repository(str(tmp_path / "app.db"))
+    repo.upsert_subscription_from_resolve("tok", {"id": "sub-1", "planId": "p", "saasSubscriptionStatus": "Subscribed"})
+
+    slim = repo.get_subscription_by_token("tok", columns=SUBSCRIPTION_STATUS_COLUMNS)
+    assert slim is not None
+    assert (slim.id, slim.status) == ("sub-1", "Subscribed")
+    with pytest.raises(AttributeError):
+        slim.plan_id
+    assert not hasattr(slim, "__dict__")
+
+    full = repo.get_subscription("sub-1")
+    assert full is not None
+    assert full.plan_id == "p"
+    assert full.raw_resolve == {"id": "sub-1", "planId": "p", "saasSubscriptionStatus": "Subscribed"}
+    assert full.raw_resolve is full.raw_resolve
+
+    with pytest.raises(ValueError):
+        repo.get_subscription("sub-1", columns=("id", "1; DROP TABLE subscriptions"))
+
+
+def test_admission_sheds_rate_limited_class_only(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setenv("ADMISSION_ADMIN_RATE", "1")
+    client = _new_client(tmp_path)
+
+    assert client.get("/admin/api/subscriptions").status_code == 200
+    shed = client.get("/admin/api/subscriptions")
+    assert shed.status_code == 503
+    assert int(shed.headers["retry-after"]) >= 1
+    assert shed.json()["class"] == "admin"
+
+    assert client.post("/api/webhook", json={"subscriptionId": "s", "action": "Noop"}).status_code == 200
+    assert client.get("/healthz").status_code == 200
+
+    import app.main as main  # noqa: WPS433
+
+    stats = main.admission.stats()
+    assert stats["admin"]["shedRateLimited"] == 1
+    assert stats["webhook"]["admitted"] == 1
+
+
+def test_admission_usage_has_its_own_class(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setenv("ADMISSION_INTERACTIVE_RATE", "1")
+    client = _new_client(tmp_path)
+
+    _add_subscriptions("s")
+    record = {"resourceId": "s", "planId": "p", "dimension": "d", "quantity": 1}
+    assert client.get("/landing?token=t").status_code == 200
+    assert client.get("/landing?token=t").status_code == 503
+    # A burst of usage reports is not limited by the interactive bucket.
+    for _ in range(5):
+        assert client.post("/api/usage", json=record).status_code == 202
+
+    import app.main as main  # noqa: WPS433
+
+    stats = main.admission.stats()
+    assert stats["usage"]["admitted"] == 5
+    assert stats["interactive"]["shedRateLimited"] == 1
+
+
+def test_admission_queue_timeout_sheds_and_hands_off_slots() -> None:
+    from app.admission import ClassLimiter, ClassLimits, Shed
+
+    async def scenario() -> None:
+        limiter = ClassLimiter("webhook", ClassLimits(max_concurrency=1, rate_per_second=0, max_queue_seconds=0.05))
+        await limiter.acquire()
+
+        with pytest.raises(Shed) as shed:
+            await limiter.acquire()
+        assert shed.value.reason == "queue_timeout"
+
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0.01)
+        assert limiter.stats()["queued"] == 1
+        limiter.release()
+        await waiting
+        assert limiter.stats()["inFlight"] == 1
+        limiter.release()
+        assert limiter.stats()["inFlight"] == 0
+        assert limiter.stats()["shedQueueTimeout"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_online_backup_does_not_stall_writers(tmp_path: Path) -> None:
+    from app.backup import BackupManager
+    from app.db import Repository, connect
+
+    db_path = str(tmp_path / "app.db")
+    repo = Repository(db_path)
+    rows = 1500
+    with connect(db_path) as conn:
+        conn.executemany(
+            "INSERT INTO subscriptions (id, status, raw_resolve_json) VALUES (?, 'Subscribed', ?)",
+            [(f"sub-{i}", "x" * 4000) for i in range(rows)],
+        )
+        conn.commit()
+
+    def p99_write_ms(during: threading.Event) -> tuple[float, int]:
+        latencies: list[float] = []
+        i = 0
+        while during.is_set() or not latencies:
+            started = time.perf_counter()
+            repo.update_status(f"sub-{i % rows}", "Suspended")
+            latencies.append(time.perf_counter() - started)
+            i += 1
+        latencies.sort()
+        return latencies[int(len(latencies) * 0.99)] * 1000, len(latencies)
+
+    def p99_during(copy) -> tuple[float, int, float]:
+        running = threading.Event()
+        running.set()
+        measured: dict[str, tuple[float, int]] = {}
+        writer = threading.Thread(target=lambda: measured.setdefault("during", p99_write_ms(running)))
+        writer.start()
+        started = time.perf_counter()
+        try:
+            copy()
+        finally:
+            copy_ms = (time.perf_counter() - started) * 1000
+            running.clear()
+            writer.join()
+        return (*measured["during"], copy_ms)
+
+    manager = BackupManager(db_path, str(tmp_path / "backups"), pages_per_step=16, pause_seconds=0.005)
+    results: list[dict] = []
+    during_p99, writes, copy_ms = p99_during(lambda: results.append(manager.run()))
+    result = results[0]
+
+    assert result["integrity"] == "ok"
+    assert result["restarts"] == 0
+    assert result["steps"] > 1
+    assert writes > 10
+    # The copy is paced to take hundreds of ms; a writer blocked for the whole copy would see
+    # a p99 close to copy_ms.
+    assert copy_ms > 200
+    assert during_p99 < copy_ms / 4
+
+    # Control: the same paced copy while the write lock is held for its whole duration, as a
+    # blocking backup would. It must fail the assertion above.
+    def blocking_copy() -> None:
+        lock = sqlite3.connect(db_path, isolation_level=None)
+        src = sqlite3.connect(db_path)
+        dst = sqlite3.connect(str(tmp_path / "blocking.db"))
+        try:
+            lock.execute("BEGIN IMMEDIATE")
+            src.backup(dst, pages=16, progress=lambda *_: time.sleep(0.005))
+            lock.execute("COMMIT")
+        finally:
+            dst.close()
+            src.close()
+            lock.close()
+
+    blocked_p99, _, blocked_copy_ms = p99_during(blocking_copy)
+    assert not blocked_p99 < blocked_copy_ms / 4
+
+    snapshot = sqlite3.connect(result["path"])
+    try:
+        assert snapshot.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0] == rows
+    finally:
+        snapshot.close()
+
+
+def test_admin_backup_rotates_snapshots(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setenv("BACKUP_KEEP", "2")
+    client = _new_client(tmp_path)
+
+    client.post("/api/resolve", json={"token": "backup-token"})
+    # Left behind by a worker that crashed mid-copy.
+    (tmp_path / "backups").mkdir()
+    (tmp_path / "backups" / "app-20260101T000000000000Z.db.partial").write_bytes(b"")
+    for _ in range(3):
+        r = client.post("/admin/api/backups")
+        assert r.status_code == 200
+        assert r.json()["integrity"] == "ok"
+
+    # Not snapshots, even though they share the database's name prefix.
+    (tmp_path / "backups" / "app-cache.db").write_bytes(b"")
+    (tmp_path / "backups" / "app-notes.db").write_bytes(b"")
+
+    listed = client.get("/admin/api/backups").json()
+    assert listed["count"] == 2
+    assert not any(name.endswith(".partial") for name in os.listdir(tmp_path / "backups"))
+    assert (tmp_path / "backups" / "app-cache.db").exists()
+
+
+def test_scheduled_backup_runs_once_per_interval_across_workers(tmp_path: Path) -> None:
+    from app.backup import BackupManager
+    from app.db import Repository
+
+    db_path = str(tmp_path / "app.db")
+    Repository(db_path)
+    workers = [BackupManager(db_path, str(tmp_path / "backups"), interval_seconds=3600) for _ in range(3)]
+
+    results = [w.run(min_age_seconds=3600) for w in workers]
+    assert [r is not None for r in results] == [True, False, False]
+    assert len(workers[0].list()) == 1
+
+    # Once the newest snapshot is old enough, whichever worker comes next takes one.
+    assert workers[2].run(min_age_seconds=0) is not None
+    assert len(workers[0].list()) == 2
+
+
+def test_request_deadline_flows_into_resolve(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setenv("REQUEST_DEADLINE_MS", "200")
+    client = _new_client(tmp_path)
+
+    import app.main as main  # noqa: WPS433
+
+    budgets: list[float] = []
+
+    def _slow_resolve(token: str, deadline) -> dict:
+        budgets.append(deadline.remaining())
+        deadline.timeout(30)  # still within budget
+
+        time.sleep(deadline.remaining() + 0.01)
+        deadline.timeout(30)  # budget spent: raises DeadlineExceeded
+        return {}
+
+    main.mp._resolve_once = _slow_resolve  # type: ignore[method-assign]
+    r = client.get("/landing?token=slow-token")
+    assert r.status_code == 504
+    assert 0 < budgets[0] <= 0.2
+
+
+def test_resolve_hedging_takes_first_finisher(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setenv("RESOLVE_HEDGING_ENABLED", "true")
+    monkeypatch.setenv("RESOLVE_HEDGE_DELAY_MS", "20")
+    client = _new_client(tmp_path)
+
+    import app.main as main  # noqa: WPS433
+
+    real_resolve = main.mp._resolve_once
+    attempts: list[int] = []
+    lock = threading.Lock()
+
+    def _first_attempt_stalls(token: str, deadline) -> dict:
+        with lock:
+            attempts.append(len(attempts) + 1)
+            attempt = attempts[-1]
+        if attempt == 1:
+            time.sleep(0.5)
+        return real_resolve(token, deadline)
+
+    main.mp._resolve_once = _first_attempt_stalls  # type: ignore[method-assign]
+    started = time.monotonic()
+    r = client.post("/api/resolve", json={"token": "hedged-token"})
+    assert r.status_code == 200
+    assert time.monotonic() - started < 0.4
+
+    stats = client.get("/admin/api/marketplace").json()
+    assert stats["hedgesSent"] == 1
+    assert stats["hedgeWins"] == 1
+    assert stats["hedgeWinRate"] == 1.0
+
+
+def test_resolve_hedging_skips_hedge_when_pool_is_saturated(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setenv("RESOLVE_HEDGING_ENABLED", "true")
+    monkeypatch.setenv("RESOLVE_HEDGE_DELAY_MS", "20")
+    monkeypatch.setenv("ADMISSION_INTERACTIVE_CONCURRENCY", "1")
+    _new_client(tmp_path)
+
+    import app.main as main  # noqa: WPS433
+
+    executor = main.mp._executor()
+    assert executor._max_workers == 2
+    release = threading.Event()
+    busy = [executor.submit(release.wait) for _ in range(2)]
+
+    threading.Timer(0.2, release.set).start()
+    assert main.mp.resolve("saturated-token")["id"]
+    assert all(f.done() for f in busy)
+    # The first attempt was still queued at the hedge delay, so no hedge was sent.
+    assert main.mp.hedge_stats()["hedgesSent"] == 0
+
+
+def _init_db_in_subprocess(db_path: str) -> None:
+    from app.db import init_db
+
+    init_db(db_path)
+
+
+def test_init_db_is_safe_across_worker_processes(tmp_path: Path) -> None:
+    db_path = str(tmp_path / "app.db")
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=_init_db_in_subprocess, args=(db_path,)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(timeout=60)
+    assert [p.exitcode for p in procs] == [0, 0, 0, 0]
+
+    from app.db import SCHEMA_VERSION
+
+    conn = sqlite3.connect(db_path)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    finally:
+        conn.close()
+
+
+def test_entra_token_is_shared_between_clients(tmp_path: Path, monkeypatch) -> None:
+    import app.marketplace as marketplace
+    from app.config import Settings
+    from app.shared_cache import SharedCache
+
+    acquired: list[int] = []
+
+    class _FakeMsalApp:
+        def __init__(self, **kwargs) -> None:
+            pass
+
+        def acquire_token_for_client(self, scopes: list[str]) -> dict:
+            acquired.append(1)
+            return {"access_token": f"token-{len(acquired)}", "expires_in": 3600}
+
+    monkeypatch.setattr(marketplace.msal, "ConfidentialClientApplication", _FakeMsalApp)
+    settings = Settings(
+        marketplace_mode="live",
+        ENTRA_TENANT_ID="tenant",
+        ENTRA_CLIENT_ID="client",
+        ENTRA_CLIENT_SECRET="secret",
+    )
+    cache_path = str(tmp_path / "cache.db")
+
+    worker1 = marketplace.MarketplaceClient(settings=settings, shared_cache=SharedCache(cache_path))
+    worker2 = marketplace.MarketplaceClient(settings=settings, shared_cache=SharedCache(cache_path))
+
+    assert worker1._get_access_token() == "token-1"
+    assert worker2._get_access_token() == "token-1"
+    assert len(acquired) == 1
+
+
+def test_webhook_redeliveries_are_stored_once(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setenv("WEBHOOK_DEDUPE_CACHE_SIZE", "1")
+    client = _new_client(tmp_path)
+    sub_id = client.post("/api/resolve", json={"token": "wh-token"}).json()["subscriptionId"]
+
+    event = {
+        "id": "op-1",
+        "subscriptionId": sub_id,
+        "action": "Suspend",
+        "status": "Suspended",
+        "timeStamp": "2026-01-01T10:00:00.1234567Z",
+    }
+    assert client.post("/api/webhook", json=event).json() == {"ok": True}
+    # Caught by the in-memory filter.
+    assert client.post("/api/webhook", json=event).json()["duplicate"] is True
+    # Evict op-1 from the (size 1) filter; the unique index still catches the redelivery.
+    client.post("/api/webhook", json={**event, "id": "op-2", "status": "Subscribed", "timeStamp": "2026-01-01T11:00:00Z"})
+    assert client.post("/api/webhook", json=event).json()["duplicate"] is True
+
+    events = client.get("/admin/api/webhook-events", params={"subscriptionId": sub_id}).json()["items"]
+    assert sorted(e["eventId"] for e in events) == ["op-1", "op-2"]
+
+    stats = client.get("/admin/api/webhook-stats").json()
+    assert stats["received"] == 4
+    assert stats["duplicatesFromMemory"] == 1
+    assert stats["duplicatesFromDb"] == 1
+    assert stats["duplicateRate"] == 0.5
+
+
+def test_webhook_rejects_out_of_order_status(tmp_path: Path) -> None:
+    client = _new_client(tmp_path)
+    sub_id = client.post("/api/resolve", json={"token": "order-token"}).json()["subscriptionId"]
+
+    newer = {"id": "op-new", "subscriptionId": sub_id, "status": "Unsubscribed", "timeStamp": "2099-01-01T12:00:00Z"}
+    older = {"id": "op-old", "subscriptionId": sub_id, "status": "Subscribed", "timeStamp": "2099-01-01T11:00:00Z"}
+    client.post("/api/webhook", json=newer)
+    client.post("/api/webhook", json=older)
+
+    assert client.get(f"/admin/api/subscriptions/{sub_id}").json()["status"] == "Unsubscribed"
+    assert client.get("/admin/api/webhook-stats").json()["statusNotApplied"] == 1
+
+    # Our own changes don't compare against the (possibly skewed) webhook clock.
+    resp = client.post(f"/admin/api/subscriptions/{sub_id}/status", json={"status": "Suspended"})
+    assert resp.status_code == 200
+    assert client.get(f"/admin/api/subscriptions/{sub_id}").json()["status"] == "Suspended"
+    assert client.post("/api/activate", json={"subscriptionId": sub_id}).status_code == 200
+    assert client.get(f"/admin/api/subscriptions/{sub_id}").json()["status"] == "Subscribed"
+
+
+def test_webhook_redelivery_applies_status_after_failed_write(tmp_path: Path, monkeypatch) -> None:
+    import app.db as db
+
+    client = _new_client(tmp_path)
+    sub_id = client.post("/api/resolve", json={"token": "retry-token"}).json()["subscriptionId"]
+    event = {"id": "op-fail", "subscriptionId": sub_id, "status": "Suspended", "timeStamp": "2026-01-01T10:00:00Z"}
+
+    real_apply_status = db._apply_status
+    calls: list[str] = []
+
+    def _fails_once(*args, **kwargs):
+        calls.append(args[1])
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        return real_apply_status(*args, **kwargs)
+
+    monkeypatch.setattr(db, "_apply_status", _fails_once)
+    with pytest.raises(RuntimeError):
+        client.post("/api/webhook", json=event)
+
+    # Marketplace redelivers after the failed ack; the event was neither stored nor remembered.
+    assert client.post("/api/webhook", json=event).json() == {"ok": True}
+    assert client.get(f"/admin/api/subscriptions/{sub_id}").json()["status"] == "Suspended"
+    assert [e["eventId"] for e in client.get("/admin/api/webhook-events").json()["items"]] == ["op-fail"]
+
+
+def test_init_db_migrates_v1_database(tmp_path: Path) -> None:
+    from app.db import SCHEMA_VERSION, Repository
+
+    db_path = str(tmp_path / "app.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE webhook_events (id INTEGER PRIMARY KEY AUTOINCREMENT, subscription_id TEXT,"
+        " action TEXT, payload_json TEXT, received_at TEXT)"
+    )
+    conn.execute("INSERT INTO webhook_events (subscription_id, action) VALUES ('s', 'Old')")
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    conn.close()
+
+    repo = Repository(db_path)
+    assert repo.add_webhook_event("s", "New", {}, event_id="op-1") is True
+    assert repo.add_webhook_event("s", "New", {}, event_id="op-1") is False
+    assert len(repo.list_webhook_events()) == 2
+
+    conn = sqlite3.connect(db_path)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    finally:
+        conn.close()
+
+
+def test_usage_failed_stage_keeps_aggregates(tmp_path: Path) -> None:
+    client = _new_client(tmp_path)
+    import app.main as main  # noqa: WPS433
+
+    r = client.post("/api/usage", json={"resourceId": "s", "planId": "p", "dimension": "d", "quantity": "nan"})
+    assert r.status_code == 400
+
+    main.meter.record("s", "p", "d", 3)
+    real_stage = main.repo.stage_usage
+
+    def _locked(aggregates: dict) -> int:
+        raise RuntimeError("database is locked")
+
+    main.repo.stage_usage = _locked  # type: ignore[method-assign]
+    main.meter.record("s2", "p", "d", 1)
+    with pytest.raises(RuntimeError):
+        main.meter.stage()
+    assert main.meter.pending_in_memory() == 2
+
+    main.repo.stage_usage = real_stage  # type: ignore[method-assign]
+    main.meter.stage()
+    assert main.repo.count_usage_by_status() == {"Pending": 2}
+
+
+def test_usage_staged_during_flush_is_recorded_as_late(tmp_path: Path) -> None:
+    client = _new_client(tmp_path)
+    import app.main as main  # noqa: WPS433
+
+    hour = datetime(2026, 1, 1, 8, tzinfo=timezone.utc)
+    main.meter.record("sub", "plan", "dim", 5, hour)
+    main.meter.stage()
+
+    # Within the grace period after the hour ends nothing is sent.
+    assert main.meter.flush(now=hour + timedelta(hours=1, seconds=1))["submitted"] == 0
+
+    real_post = main.mp.post_usage_batch
+    dropped: list[int] = []
+
+    def _post_while_staging(items: list[dict]) -> dict:
+        main.meter.record("sub", "plan", "dim", 7, hour)
+        dropped.append(main.meter.stage())
+        return real_post(items)
+
+    main.mp.post_usage_batch = _post_while_staging  # type: ignore[method-assign]
+    stats = main.meter.flush(now=hour + timedelta(hours=2))
+
+    # After the hour is reported, more usage for it can't be billed either.
+    main.meter.record("sub", "plan", "dim", 2, hour)
+    dropped.append(main.meter.stage())
+
+    assert stats["accepted"] == 1
+    assert dropped == [1, 1]
+    from app.db import connect
+
+    with connect(main.settings.database_path) as conn:
+        row = conn.execute("SELECT quantity, status, late_quantity FROM usage_records").fetchone()
+    assert tuple(row) == (5, "Accepted", 9)
+    assert client.get("/admin/api/usage").json()["droppedLate"] == {"records": 1, "quantity": 9}